@@ -23,26 +23,222 @@
 
 import re
 import os
+import shutil
 from pyleaf import log
+from pyleaf import lgl
 import sys
 
+class graphindex():
+    """Lookup structures of a graph: forward and reverse adjacency in
+    edge-id order, a topological order and, for each node, its
+    ancestors and descendants as bitsets over the positions of the
+    topological order. Adding nodes or edges updates them in place;
+    removing nodes or edges only drops reachability, which is
+    recomputed the next time it is needed.
+
+    """
+
+    def __init__(self, g):
+        self.nodes = dict()
+        for node in g.keys():
+            self.nodes[node] = None
+            for onode in dict.__getitem__(g, node):
+                self.nodes[onode] = None
+        self.outs = dict()
+        self.ins = dict()
+        for node in self.nodes:
+            self.outs[node] = list()
+            self.ins[node] = list()
+        self.edges = set()
+        for node in g.keys():
+            for onode in dict.__getitem__(g, node):
+                if not (node, onode) in self.edges:
+                    self.edges.add((node, onode))
+                    self.ins[onode].append(node)
+                    self.outs[node].append(onode)
+        for node in self.nodes:
+            self.ins[node].sort(key=lambda x: g._edgeKey(x, node))
+            self.outs[node].sort(key=lambda x: g._edgeKey(node, x))
+        self.attribs = None
+        self.order = None
+        self.dropReach()
+
+    def dropReach(self):
+        self.order = None
+        self.pos = None
+        self.anc = None
+        self.desc = None
+        self.sets = dict()
+
+    def addNode(self, node):
+        if not node in self.nodes:
+            self.nodes[node] = None
+            self.outs[node] = list()
+            self.ins[node] = list()
+            if self.order != None:
+                self.pos[node] = len(self.order)
+                self.order.append(node)
+                self.anc[node] = 0
+                self.desc[node] = 0
+
+    def buildReach(self):
+        # Kahn's algorithm; nodes on cycles, if any, are appended last
+        missing = dict([(node, len(self.ins[node])) for node in self.nodes])
+        order = [node for node in self.nodes if missing[node] == 0]
+        for node in order:
+            for onode in self.outs[node]:
+                missing[onode] -= 1
+                if missing[onode] == 0:
+                    order.append(onode)
+        if len(order) < len(self.nodes):
+            seen = set(order)
+            order.extend([x for x in self.nodes if not x in seen])
+        self.order = order
+        self.pos = dict([(node, i) for i, node in enumerate(order)])
+        self.anc = dict()
+        for node in order:
+            bits = 0
+            for innode in self.ins[node]:
+                bits |= self.anc.get(innode, 0) | (1 << self.pos[innode])
+            self.anc[node] = bits
+        self.desc = dict()
+        for node in reversed(order):
+            bits = 0
+            for onode in self.outs[node]:
+                bits |= self.desc.get(onode, 0) | (1 << self.pos[onode])
+            self.desc[node] = bits
+        self.sets = dict()
+
+    def insert(self, nodes, node, key):
+        # inserts node in nodes, kept sorted by key. Edge ids mostly
+        # grow, so that new nodes usually go last
+        k = key(node)
+        if len(nodes) == 0 or key(nodes[-1]) <= k:
+            nodes.append(node)
+            return
+        lo, hi = 0, len(nodes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if k < key(nodes[mid]):
+                hi = mid
+            else:
+                lo = mid + 1
+        nodes.insert(lo, node)
+
+    def link(self, a, b, g):
+        # adds the edge from a to b in edge-id order
+        self.addNode(a)
+        self.addNode(b)
+        self.edges.add((a, b))
+        self.insert(self.outs[a], b, lambda x: g._edgeKey(a, x))
+        self.insert(self.ins[b], a, lambda x: g._edgeKey(x, b))
+        self.addEdge(a, b)
+
+    def unlink(self, a, b):
+        self.edges.discard((a, b))
+        self.outs[a].remove(b)
+        self.ins[b].remove(a)
+        self.dropReach()
+
+    def addEdge(self, a, b):
+        # reachability is kept if the topological order still holds
+        self.sets = dict()
+        if self.order == None:
+            return
+        if self.pos[a] >= self.pos[b]:
+            self.dropReach()
+            return
+        up = self.anc[a] | (1 << self.pos[a])
+        down = self.desc[b] | (1 << self.pos[b])
+        for node in self.nodesOf(down):
+            self.anc[node] |= up
+        for node in self.nodesOf(up):
+            self.desc[node] |= down
+
+    def nodesOf(self, bits):
+        # bit i stands for the node at position i
+        digits = bin(bits)[:1:-1]
+        order = self.order
+        nodes = list()
+        i = digits.find('1')
+        while i >= 0:
+            nodes.append(order[i])
+            i = digits.find('1', i + 1)
+        return nodes
+
+    def reach(self, node, kind):
+        # ancestors (kind 'anc') or descendants ('desc') of node
+        if self.order == None:
+            self.buildReach()
+        if not (node, kind) in self.sets:
+            bits = self.anc[node] if kind == 'anc' else self.desc[node]
+            self.sets[(node, kind)] = frozenset(self.nodesOf(bits))
+        return self.sets[(node, kind)]
+
+
+def dotId(node):
+    # node names may contain characters that are not valid in dot IDs
+    # (shards are named node[i], alternatives node[alt])
+    return '"' + str(node).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# attributes not affecting the results of a node
+cosmetic = ['id', 'label', 'color', 'group', 'executor', 'stream', 'cpus',
+            'mem', 'codec', 'compress']
+
+
 class graph(dict):
+    def __setitem__(self, node, onodes):
+        old = dict.get(self, node)
+        dict.__setitem__(self, node, onodes)
+        index = self.__dict__.get('_index')
+        if index == None:
+            return
+        # the index is updated in place, like in addEdge
+        index.addNode(node)
+        if old:
+            for onode in list(index.outs[node]):
+                index.unlink(node, onode)
+        for onode in onodes:
+            if not (node, onode) in index.edges:
+                index.link(node, onode, self)
+
+    def __delitem__(self, node):
+        dict.__delitem__(self, node)
+        self._touch()
+
+    def __getstate__(self):
+        # the index is rebuilt when needed rather than stored
+        state = dict(self.__dict__)
+        state.pop('_index', None)
+        return state
+
+    def _touch(self):
+        if self.__dict__.get('_index') != None:
+            self._index = None
+
+    def _getIndex(self):
+        if self.__dict__.get('_index') == None:
+            self._index = graphindex(self)
+        return self._index
+
+    def _edgeKey(self, a, b):
+        # edges without an id follow the others
+        eid = self._edgeattribs.get(((a, b), 'id'))
+        return (eid == None, eid)
+
     def getNodes(self):
-        nodes = self.keys()
-        for value in self._reverseDict().keys():
-            if not(value in nodes):
-                nodes.append(value)
-        return nodes
+        return list(self._getIndex().nodes)
+
+    def hasNode(self, node):
+        return node in self._getIndex().nodes
 
     def getInNodes(self, node):        
         # nodes are returned in edge-id order
-        g = self._reverseDict()        
-        ids = [self.getEdgeAttrib((x, node), 'id') for x in g[node]]
-        return [x[1] for x in sorted(zip(ids, g[node]))]
+        return list(self._getIndex().ins[node])
         
     def getOutNodes(self, node):
-        ids = [self.getEdgeAttrib((node, x), 'id') for x in self[node]]
-        return [x[1] for x in sorted(zip(ids, self[node]))]
+        return list(self._getIndex().outs[node])
         
     def isLeaf(self, node):
         return self[node]==[]
@@ -54,95 +250,187 @@ node [shape=box, style=rounded];
 rankdir=LR;
 """)
         for idx, node in enumerate(self.getNodes()):
-            f.write(str(node))
-            f.write('[label = ' + node + ']\n')
+            f.write(dotId(node))
+            f.write('[label = ' + dotId(node) + ']\n')
         for node in self.keys():
             for onode in self[node]:
-                f.write(node + ' -> ' + onode + '\n')
+                f.write(dotId(node) + ' -> ' + dotId(onode) + '\n')
         f.write('}')
         f.close()
         os.system('dot -Tpdf -o' + ofile + '.pdf ' + ofile)
 
     def getAncestors(self, node):
-        anc = set()
-        g = self._reverseDict()
-        stack = list()
-        stack.append(node)
-
-        while len(stack) != 0:
-            n = stack.pop()
-            for parent in g[n]:
-                anc.add(parent)
-                stack.append(parent)
-        return anc            
-
-    def _reverseDict(self):
-        g = self
-        all_values = list()
-        for item in g.values():
-            for subitem in item:
-                if not (subitem in all_values):
-                    all_values.append(subitem)
-        
-        rg=dict.fromkeys(all_values)
-        for key in rg:
-            rg[key] = []
-        for value in all_values:
-            for key in g.keys():
-                if value in g[key]:
-                    rg[value].append(key)
-        for value in g.keys():
-            if not(value in rg.keys()):
-                rg[value]=[]
-
-        #for key in rg.keys():
-        #   rg[key]=sorted(rg[key])
-
-        return rg
+        return self._getIndex().reach(node, 'anc')
+
+    def getDescendants(self, node):
+        return self._getIndex().reach(node, 'desc')
+
+    def getTopoOrder(self):
+        index = self._getIndex()
+        if index.order == None:
+            index.buildReach()
+        return list(index.order)
+
+    def addNode(self, node):
+        if node in self:
+            return
+        dict.__setitem__(self, node, list())
+        index = self.__dict__.get('_index')
+        if index != None:
+            index.addNode(node)
+
+    def addEdge(self, a, b, eid=None):
+        if eid != None:
+            self._edgeattribs[(a, b), 'id'] = eid
+        if not a in self:
+            dict.__setitem__(self, a, list())
+        if not b in self:
+            dict.__setitem__(self, b, list())
+        index = self._getIndex()
+        if (a, b) in index.edges:
+            return
+        dict.__getitem__(self, a).append(b)
+        index.link(a, b, self)
+
+    def hasEdge(self, a, b):
+        return (a, b) in self._getIndex().edges
+
+    def delEdge(self, a, b):
+        targets = dict.__getitem__(self, a)
+        if not b in targets:
+            return
+        del(targets[targets.index(b)])
+        index = self.__dict__.get('_index')
+        if index != None:
+            index.unlink(a, b)
 
     def getAttrib(self, node, attr):
         if (node, attr) in self._nodeattribs:
             return self._nodeattribs[(node, attr)]
         return None
 
-        
+    def getAttribs(self, node):
+        index = self._getIndex()
+        if index.attribs == None:
+            index.attribs = dict()
+            for (anode, attr) in self._nodeattribs.keys():
+                index.attribs.setdefault(anode, set()).add(attr)
+        attribs = dict()
+        for attr in index.attribs.get(node, ()):
+            attribs[attr] = self._nodeattribs[(node, attr)]
+        return attribs
+
     def setAttrib(self, node, attr, value):
         log.send('Setting ' + 
             str(attr) + ' = ' + str(value) +
             ' for node: ' + str(node), 3)
         self._nodeattribs[(node, attr)] = value
+        index = self.__dict__.get('_index')
+        if index != None and index.attribs != None:
+            index.attribs.setdefault(node, set()).add(attr)
         
     def delNode(self, node):
-        del(self[node])
-        for targets in self.values():
-            if node in targets:
-                del(targets[targets.index(node)])
+        index = self._getIndex()
+        for innode in index.ins[node]:
+            targets = dict.__getitem__(self, innode)
+            del(targets[targets.index(node)])
+            index.outs[innode].remove(node)
+            index.edges.discard((innode, node))
+        for onode in index.outs[node]:
+            index.ins[onode].remove(node)
+            index.edges.discard((node, onode))
+        if node in self:
+            dict.__delitem__(self, node)
+        del(index.nodes[node])
+        del(index.outs[node])
+        del(index.ins[node])
+        index.dropReach()
+
+    def addFamily(self, node, shards):
+        # node is expanded into one node per shard, named node[i]
+        # and bound to the same function, which receives i as its
+        # last argument; node itself becomes the gather node, getting
+        # the results of all the shards in a list
+        if self.getAttrib(node, 'gather') != None:
+            raise NameError('Node ' + node + ' is already a family.')
+        innodes = self.getInNodes(node)
+        attribs = self.getAttribs(node)
+        eids = [v for ((x, key), v) in self._edgeattribs.items() if key == 'id']
+        nids = [v for ((x, key), v) in self._nodeattribs.items() if key == 'id']
+        eid = max([-1] + [x for x in eids if x != None]) + 1
+        nid = max([-1] + [x for x in nids if x != None]) + 1
+        for shard in shards:
+            name = node + '[' + str(shard) + ']'
+            for key in attribs.keys():
+                if not key in ['id', 'label', 'shards']:
+                    self.setAttrib(name, key, attribs[key])
+            self.setAttrib(name, 'id', nid)
+            self.setAttrib(name, 'label', name)
+            if attribs.get('bind') == None:
+                self.setAttrib(name, 'bind', node)
+            self.setAttrib(name, 'hash', 'true')
+            self.setAttrib(name, 'family', node)
+            self.setAttrib(name, 'shard', shard)
+            nid += 1
+            for innode in innodes:
+                self.addEdge(innode, name, eid)
+                eid += 1
+            self.addEdge(name, node, eid)
+            eid += 1
+        for innode in innodes:
+            self.delEdge(innode, node)
+            self._edgeattribs.pop(((innode, node), 'id'), None)
+        self.setAttrib(node, 'gather', 'true')
+        self.setAttrib(node, 'hash', 'true')
+        self._touch()
+
+    def diff(self, old):
+        # the nodes of this graph whose results may differ from those
+        # of the same nodes in old, each with the reasons why, in
+        # topological order. New nodes are not reported.
+        reasons = dict()
+        for node in self.getTopoOrder():
+            if not old.hasNode(node):
+                continue
+            why = list()
+            inputs = self.getInNodes(node)
+            oldinputs = old.getInNodes(node)
+            for innode in inputs:
+                if not innode in oldinputs:
+                    why.append('new input: ' + innode)
+            for innode in oldinputs:
+                if not innode in inputs:
+                    why.append('input removed: ' + innode)
+            if len(why) == 0 and inputs != oldinputs:
+                why.append('inputs reordered: ' + ', '.join(inputs))
+            bind = self.getAttrib(node, 'bind') or node
+            oldbind = old.getAttrib(node, 'bind') or node
+            if bind != oldbind:
+                why.append('bound to ' + bind + ' instead of ' + oldbind)
+            attribs = self.getAttribs(node)
+            oldattribs = old.getAttribs(node)
+            for attr in sorted(set(attribs) | set(oldattribs)):
+                if attr in cosmetic or attr == 'bind':
+                    continue
+                if attr == 'chunk' and attr in attribs and attr in oldattribs:
+                    #only mapping matters, not the chunk size
+                    continue
+                if attribs.get(attr) != oldattribs.get(attr):
+                    why.append(attr + ' changed: ' +
+                               str(oldattribs.get(attr)) + ' -> ' +
+                               str(attribs.get(attr)))
+            for innode in inputs:
+                if innode in reasons:
+                    why.append('input changed: ' + innode)
+            if len(why) > 0:
+                reasons[node] = why
+        return reasons
 
     def lgl2dot(self, leafprot, erroffset):
         f=open('leafprot.lf', 'w')
         f.write(leafprot)
         f.close()
 
-        ## Regression: the following will cause troubles in windows
-        ## because of the "exe" extension.
-        # def findLglcBin():
-        #     for path in os.environ["PATH"].split(os.pathsep):
-        #         lglcbin = os.path.join(path, 'lglc')
-        #         if os.path.isfile(lglcbin):
-        #             return lglcbin
-        #         else:
-        #             NameError('Error while searching for lglc binary. Is it in your PATH?')
-        #     return lglcbin
-            
-        # lglcbin = findLglcBin()
-        # if not os.access(lglcbin, os.X_OK):
-        #     raise NameError('Error while running binary ' +\
-        #                         lglcbin +
-        #                     '. Please make sure that it is the correct LGL Compiler binary and that you have proper permissions to run it.')
-
-        # t=os.system(os.path.join(lglcbin) +
-        #             ' leafprot.lf -l' + str(erroffset))
-
         t=os.system('lglc' +
                     ' leafprot.lf -l' + str(erroffset))
 
@@ -150,15 +438,20 @@ rankdir=LR;
             raise NameError('Error while running lglc. '+
                             'If I was able to run it, it produced an error message. ' +
                             'Otherwise make sure you can successfully run lglc from a system shell.')
-        #t=os.system('dot -Tpdf leafprot.lf.dot -otemp.pdf')
-        #if t!=0:
-        #    raise NameError('Problems running dot: have you installed it?')
-                                
+
         a = open('leafprot.lf.dot','r').read()
         return a
 
     def setEdgeAttrib(self, edge, key, value):
         self._edgeattribs[edge, key]=value
+        index = self.__dict__.get('_index')
+        if key == 'id' and index != None and edge in index.edges:
+            # only the edge is moved to its new place
+            a, b = edge
+            index.outs[a].remove(b)
+            index.ins[b].remove(a)
+            index.insert(index.outs[a], b, lambda x: self._edgeKey(a, x))
+            index.insert(index.ins[b], a, lambda x: self._edgeKey(x, b))
 
     def getEdgeAttrib(self, edge, key):
         return self._edgeattribs[edge, key]
@@ -169,8 +462,8 @@ rankdir=LR;
         elif language == 'ldot':
             self._fromLdot(source, erroffset)
 
-    def _fromLdot(self, source):
-        for key in self.keys():
+    def _fromLdot(self, source, erroffset=0):
+        for key in list(self.keys()):
             del(self[key])
 
         a = source
@@ -202,10 +495,7 @@ rankdir=LR;
         for edge in edges:
             thisnodes = re.findall('\d+', edge[0])
             key = names[thisnodes[0]]
-            if key in self.keys():
-                self[key].append(names[thisnodes[1]])
-            else:
-                self[key]=[names[thisnodes[1]]]
+            self.addEdge(key, names[thisnodes[1]])
             eattrib = re.findall('(.*)=(.*)', edge[1])[0]
 
             ## IDs are converted to integer numbers
@@ -233,12 +523,72 @@ rankdir=LR;
         self._nodeattribs=dict()
         self._edgeattribs=dict()
 
-        a = self.lgl2dot(leafprot, erroffset)
+        for key in list(self.keys()):
+            del(self[key])
 
-        self._fromLdot(a)
+        try:
+            lgl.compile(leafprot, self, erroffset)
+        except NameError as e:
+            # lglc constructs that pyleaf.lgl does not support (merge
+            # trees, function definitions...) are left to lglc, if it
+            # is installed
+            if shutil.which('lglc') == None:
+                raise
+            log.send('Compiling through lglc: ' + str(e), 2)
+            self._nodeattribs=dict()
+            self._edgeattribs=dict()
+            try:
+                self._fromLdot(self.lgl2dot(leafprot, erroffset))
+            except NameError:
+                raise e
+        log.send('Graph is: ' + str(self), 2)
 
 
         
     _nodeattribs = dict()
     _edgeattribs = dict()
 
+
+
+class graphview():
+    # a graph without some of its nodes: the base graph is shared
+    # rather than copied until a full graph is needed
+    def __init__(self, base, excluded=()):
+        self._base = base
+        self._excluded = frozenset(excluded)
+
+    def getNodes(self):
+        return [x for x in self._base.getNodes() if not x in self._excluded]
+
+    def hasNode(self, node):
+        return self._base.hasNode(node) and not node in self._excluded
+
+    def getInNodes(self, node):
+        return [x for x in self._base.getInNodes(node)
+                if not x in self._excluded]
+
+    def getOutNodes(self, node):
+        return [x for x in self._base.getOutNodes(node)
+                if not x in self._excluded]
+
+    def getAttrib(self, node, attr):
+        return self._base.getAttrib(node, attr)
+
+    def materialize(self):
+        g = graph()
+        excluded = self._excluded
+        for node in self._base.keys():
+            if not node in excluded:
+                g[node] = [x for x in self._base[node] if not x in excluded]
+        g._nodeattribs = dict([(key, value) for (key, value)
+                               in self._base._nodeattribs.items()
+                               if not key[0] in excluded])
+        g._edgeattribs = dict([(key, value) for (key, value)
+                               in self._base._edgeattribs.items()
+                               if not key[0][0] in excluded and
+                               not key[0][1] in excluded])
+        return g
+
+    def __str__(self):
+        return str(dict([(node, self.getOutNodes(node))
+                         for node in self.getNodes()]))
@@ -0,0 +1,325 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2012-2013 Francesco Napolitano, franapoli@gmail.com
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+""" LGL compiler.
+
+    Parses the Leaf Graph Language and builds the corresponding
+    pyleaf.gph.graph directly in memory. Supported syntax:
+
+    a -> b -> c;        chains
+    a, b -> c, d;       node sets (edges from every node to every node)
+    @a -> d;            references to already defined nodes or objects;
+                        a referenced node receiving an edge has its
+                        inputs joined (hash attribute)
+       /b
+    a <                 forks, possibly nested, with "." as void root
+       \c
+    ;
+    G: a, b;            named objects; the first use of G is the object
+                        itself, later uses are copies (node names get a
+                        ".n" suffix), @G always refers to the object
+    a[F, k=v]           flags (stored in LEAF_FLAGS) and attributes
+    a[i in 0..n]        node family: a is run once for each i from 0
+                        to n-1 and its results are gathered in a list
+                        (see pyleaf.gph.graph.addFamily); bounds may be
+                        names of integers defined in the user module
+    ( ... )             grouping
+
+    Newlines and "|" are ignored, /* */ delimits comments. Node ids
+    and edge ids follow creation order.
+
+    Other lglc constructs (merge trees, "{" forks, function
+    definitions and the "<-", "-{", "}-" and "-" arrows) raise a
+    syntax error: pyleaf.gph.graph then compiles the protocol through
+    lglc, if it is installed.
+"""
+
+import re
+
+version = '1.1'
+
+_shards = re.compile(r'^(\w+)\s+in\s+(-?\w+)\s*\.\.\s*(-?\w+)$')
+
+_tokenizer = re.compile(r'''
+    (?P<space>[ \t\r\n|]+)
+  | (?P<arrow>->)
+  | (?P<attribs>\[[^\]]*\])
+  | (?P<id>\w+)
+  | (?P<punct>[/\\<,;:@.()])
+  ''', re.VERBOSE)
+
+
+class token():
+    def __init__(self, kind, value, line):
+        self.kind = kind
+        self.value = value
+        self.line = line
+
+
+def _stripComments(source):
+    # comments are replaced by their newlines, to keep line numbers
+    return re.sub(r'/\*.*?\*/', lambda m: '\n' * m.group(0).count('\n'),
+                  source, flags=re.DOTALL)
+
+
+def tokenize(source, erroffset=0):
+    source = _stripComments(source)
+    tokens = list()
+    pos = 0
+    line = 1
+    while pos < len(source):
+        m = _tokenizer.match(source, pos)
+        if m == None:
+            raise NameError('LGL syntax error around line ' +
+                            str(line + erroffset) +
+                            ': unexpected character "' + source[pos] + '".')
+        kind = m.lastgroup
+        if kind != 'space':
+            value = m.group(0)
+            if kind == 'punct':
+                kind = value
+            tokens.append(token(kind, value, line + erroffset))
+        line += m.group(0).count('\n')
+        pos = m.end()
+    tokens.append(token('end', '', line + erroffset))
+    return tokens
+
+
+class expr():
+    # entry and exit nodes of a parsed expression; refs are the entry
+    # nodes given as references
+    def __init__(self, entries=(), exits=(), refs=(), void=False):
+        self.entries = list(entries)
+        self.exits = list(exits)
+        self.refs = set(refs)
+        self.void = void
+
+    def union(self, other):
+        return expr(self.entries + other.entries, self.exits + other.exits,
+                    self.refs | other.refs)
+
+    def extend(self, other):
+        # in place union, for long node sets
+        self.entries.extend(other.entries)
+        self.exits.extend(other.exits)
+        self.refs |= other.refs
+
+
+class compiler():
+    """Compiles LGL source into a pyleaf.gph.graph."""
+
+    def __init__(self, g):
+        self._graph = g
+        self._nodeid = 0
+        self._edgeid = 0
+        self._objects = dict()
+        self._suffix = ''
+
+    def compile(self, source, erroffset=0):
+        self._tokens = tokenize(source, erroffset)
+        self._pos = 0
+        while self._tok().kind != 'end':
+            self._statement()
+        return self._graph
+
+    def _tok(self, ahead=0):
+        return self._tokens[min(self._pos + ahead, len(self._tokens) - 1)]
+
+    def _next(self):
+        tok = self._tok()
+        self._pos += 1
+        return tok
+
+    def _error(self, msg, tok=None):
+        tok = tok or self._tok()
+        raise NameError('LGL syntax error around line ' + str(tok.line) +
+                        ': ' + msg)
+
+    def _expect(self, kind):
+        if self._tok().kind != kind:
+            found = self._tok().value or 'end of protocol'
+            self._error('expected "' + kind + '", found "' + found + '".')
+        return self._next()
+
+    def _statement(self):
+        if self._tok().kind == ';':
+            self._next()
+            return
+        if self._tok().kind == 'id' and self._tok(1).kind == ':':
+            name = self._next().value
+            self._next()
+            start = self._pos
+            result = self._expr()
+            self._objects[name] = [start, self._pos, result, 0]
+        else:
+            self._expr()
+        if self._tok().kind != 'end':
+            self._expect(';')
+
+    def _expr(self):
+        # chain of node sets
+        result = self._set()
+        while self._tok().kind == 'arrow':
+            self._next()
+            target = self._set()
+            self._connect(result.exits, target)
+            result = expr(result.entries, target.exits, result.refs)
+        return result
+
+    def _set(self):
+        result = self._term()
+        if self._tok().kind != ',':
+            return result
+        # terms may be named objects: they are not changed
+        result = expr().union(result)
+        while self._tok().kind == ',':
+            self._next()
+            result.extend(self._term())
+        return result
+
+    def _term(self):
+        tok = self._tok()
+        if tok.kind == '(':
+            self._next()
+            result = self._expr()
+            self._expect(')')
+            return result
+        if tok.kind == '/':
+            return self._fork()
+        if tok.kind == '.':
+            self._next()
+            return expr(void=True)
+        if tok.kind == '@':
+            self._next()
+            name = self._expect('id').value
+            if name in self._objects:
+                result = self._objects[name][2]
+                return expr(result.entries, result.exits, result.entries)
+            if self._graph.hasNode(name + self._suffix):
+                name = name + self._suffix
+            elif not self._graph.hasNode(name):
+                self._error('Reference not found: ' + name + '.')
+            self._attribs(name)
+            return expr([name], [name], [name])
+        if tok.kind == 'id':
+            self._next()
+            if tok.value in self._objects:
+                return self._copy(tok.value)
+            name = tok.value + self._suffix
+            self._newNode(name, tok.value)
+            self._attribs(name)
+            return expr([name], [name])
+        self._error('unexpected "' + (tok.value or 'end of protocol') + '".')
+
+    def _fork(self):
+        # '/' left rootchain '<' ['/'] '\' right; with the optional
+        # '/' the fork is itself the left child of an enclosing fork
+        self._expect('/')
+        left = self._expr()
+        while True:
+            root = self._expr()
+            self._expect('<')
+            nested = self._tok().kind == '/'
+            if nested:
+                self._next()
+            self._expect('\\')
+            if not root.void:
+                self._connect(root.exits, left)
+            right = self._expr()
+            if not root.void:
+                self._connect(root.exits, right)
+                result = expr(root.entries, left.exits + right.exits,
+                              root.refs)
+            else:
+                result = left.union(right)
+            if not nested:
+                return result
+            left = result
+
+    def _copy(self, name):
+        # the first use is the object itself, then its definition is
+        # parsed again with renamed nodes
+        obj = self._objects[name]
+        if obj[3] == 0:
+            obj[3] = 1
+            return obj[2]
+        saved = self._pos, self._suffix
+        self._pos = obj[0]
+        self._suffix = self._suffix + '.' + str(obj[3])
+        obj[3] += 1
+        result = self._expr()
+        self._pos, self._suffix = saved
+        return result
+
+    def _newNode(self, name, label):
+        g = self._graph
+        if g.hasNode(name):
+            return
+        g.addNode(name)
+        g.setAttrib(name, 'id', self._nodeid)
+        g.setAttrib(name, 'label', label)
+        g.setAttrib(name, 'bind', label)
+        self._nodeid += 1
+
+    def _attribs(self, name):
+        if self._tok().kind != 'attribs':
+            return
+        tok = self._next()
+        for item in tok.value[1:-1].split(','):
+            item = item.strip()
+            if item == '':
+                continue
+            shards = _shards.match(item)
+            if shards != None:
+                bounds = [int(x) if re.match(r'^-?\d+$', x) else x
+                          for x in shards.group(2, 3)]
+                self._graph.setAttrib(name, 'shards', tuple(bounds))
+            elif '=' in item:
+                key, value = item.split('=', 1)
+                self._graph.setAttrib(name, key.strip(), value.strip())
+            else:
+                flags = self._graph.getAttrib(name, 'LEAF_FLAGS') or ''
+                self._graph.setAttrib(name, 'LEAF_FLAGS', flags + item)
+
+    def _connect(self, sources, target):
+        for source in sources:
+            for node in target.entries:
+                if node == source or self._graph.hasEdge(source, node):
+                    continue
+                self._graph.addEdge(source, node, self._edgeid)
+                self._edgeid += 1
+                if node in target.refs:
+                    self._graph.setAttrib(node, 'hash', 'true')
+
+
+def gather(*shards):
+    """Gather node of a node family: returns the results of the
+    shards in a list."""
+    return list(shards)
+
+
+def compile(source, g, erroffset=0):
+    """Builds g from the LGL source. Errors report line numbers
+    shifted by erroffset."""
+    return compiler(g).compile(source, erroffset)
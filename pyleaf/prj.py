@@ -23,11 +23,54 @@
 
 import os
 import inspect
-from pyleaf.gph import graph
+from pyleaf.gph import graph, graphview
 from pyleaf import log
+from pyleaf import lgl
 from pyleaf.ptl import protocol
-import copy
+from pyleaf.rrc import resource
 from imp import reload
+from collections.abc import MutableMapping
+
+class protocolset(MutableMapping):
+    """The alternative protocols of a project. A protocol is only
+    built, through the given function, when first accessed."""
+
+    def __init__(self, build, names=()):
+        self._build = build
+        self._names = list(names)
+        self._built = dict()
+
+    def _setNames(self, names):
+        self._names = list(names)
+        for name in list(self._built.keys()):
+            if not name in self._names:
+                del(self._built[name])
+
+    def _isBuilt(self, name):
+        return name in self._built
+
+    def __getitem__(self, name):
+        if not name in self._built:
+            if not name in self._names:
+                raise KeyError(name)
+            self._built[name] = self._build(name)
+        return self._built[name]
+
+    def __setitem__(self, name, prot):
+        if not name in self._names:
+            self._names.append(name)
+        self._built[name] = prot
+
+    def __delitem__(self, name):
+        self._names.remove(name)
+        self._built.pop(name, None)
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
 
 class project():
     """
@@ -40,7 +83,9 @@ class project():
     This class is also responsible for resource consistency check. To
     this aim, nodes source code is stored within the directory
     leaf_USERMODULENAME as the files NODENAME.mod. The graph.grp file
-    contains the pipeline structure as a pyleaf.gph.graph object.  All
+    contains the pipeline structure as a pyleaf.gph.graph object, while
+    lglcache.grp keeps the compiled protocol, so that the LGL code is
+    only compiled again when it changes.  All
     the data in these files are wrapped in leaf.rrc.resource objects
     which dump themselves through the pickle.dump method. Other files
     in the directory are produced by the leaf.ptl.protocol class.
@@ -53,6 +98,11 @@ class project():
     comments. The consistency checks can be bypassed by using the
     trust method of leaf.ptl.protocol.
 
+    Nodes sharing a group attribute are alternatives: a protocol is
+    defined for each combination of them. Such protocols are listed
+    in the protocols attribute as soon as the project is created, but
+    each one is only built when it is first accessed.
+
     Removing or renaming the directory leaf_USERMODULENAME or single
     files within it is safe. All resources associated with deleted
     files will need to be recomputed.
@@ -69,6 +119,8 @@ class project():
         self._protName = leafprot
         self._leafProt = self._seekforProt(leafprot)
         self._language = language
+        self._shared = dict()
+        self._pools = dict()
         self._initGraphs(self._leafProt)
 
     def _extract_doc(self, lglprot):
@@ -95,67 +147,123 @@ class project():
                             '" to any of your defined objects.')
         
 
-    def _updateGraphs(self, leafprot):
-        newGraph = graph()
-        newGraph.load(self._language, leafprot, self._lglSrcOff)
+    def _loadGraph(self, leafprot):
+        # the compiled graph is kept in the meta folder and reused as
+        # long as source, offset, language and compiler are the same
+        import hashlib
+        key = repr((lgl.version, self._language, self._lglSrcOff, leafprot))
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        cache = resource('lglcache', os.path.join(self._metafolder,
+                                                  'lglcache.grp'))
+        cached = cache.getValue()
+        if cached != None and cached[0] == digest:
+            log.send('Protocol unchanged: using compiled graph.', 2)
+            g = cached[1]
+        else:
+            log.send('Compiling protocol.', 2)
+            g = graph()
+            g.load(self._language, leafprot, self._lglSrcOff)
+            cache.setValue((digest, g))
+            cache.update()
+        self._expandFamilies(g)
+        return g
+
+    def _expandFamilies(self, g):
+        # family bounds can be names of integers in the user module,
+        # so that the number of shards may follow the data size
+        hislocals = self._getUserLocals()
+        for node in g.getNodes():
+            shards = g.getAttrib(node, 'shards')
+            if shards == None or g.getAttrib(node, 'gather') != None:
+                continue
+            bounds = list()
+            for bound in shards:
+                if type(bound) == str:
+                    if not bound in hislocals:
+                        raise NameError('I couldn''t bind ' + bound +
+                                        ' to any of your defined objects.')
+                    bound = hislocals[bound]
+                bounds.append(int(bound))
+            log.send('Expanding ' + node + ' into ' +
+                     str(bounds[1] - bounds[0]) + ' shards.', 2)
+            g.addFamily(node, range(bounds[0], bounds[1]))
 
-            #TODO: the following includes stuff copy-pasted
-            #from i_nitGraphs. Should be restructured.
-        self._graph = newGraph
+    def _updateGraphs(self, leafprot):
+        self._graph = self._loadGraph(leafprot)
+        self._mods = self._seekforMods()
+        self._doc = self._extract_doc(leafprot)
 
         altgraphs = self._generateAltGraphs()
-        mods = self._seekforMods()
-        
-            #import pdb; pdb.set_trace()
-
+        self.protocols._setNames(altgraphs.keys())
         for gname in altgraphs.keys():
-            if str(gname) != '':
-                altfolder = os.path.join(self._metafolder,
-                                         str(gname).strip('[]').\
-                                             replace(', ','').replace('\'', ''))
-            else:
-                altfolder = self._metafolder.strip('[]').\
-                    replace(', ','').replace('\'', '')
-
-                if not os.path.exists(altfolder):
-                    os.mkdir(altfolder)
-                
-                #self.protocols[gname]=protocol(altgraphs[gname], mods, altfolder)
-                self.protocols[gname]._setMetaFolder(altfolder)
-                #g = self.protocols[gname]._getGraph()                
-                self.protocols[gname]._update(altgraphs[gname], mods)
-                
+            if self.protocols._isBuilt(gname):
+                prot = self.protocols[gname]
+                prot._setMetaFolder(self._altFolder(gname))
+                prot._update(altgraphs[gname].materialize(), self._mods)
+                self._shareNodes(prot)
             
     def _initGraphs(self, leafprot):
         if leafprot == '':
             leafprot = self._guessLeafProt()
 
-        self._graph.load(self._language, leafprot, self._lglSrcOff)
-        
-        mods = self._seekforMods()
+        self._graph = self._loadGraph(leafprot)
+        self._mods = self._seekforMods()
+        self._doc = self._extract_doc(leafprot)
 
+        #protocols are only built when first accessed
         altgraphs = self._generateAltGraphs()
-        for gname in altgraphs.keys():
-            if str(gname) != '':
-                altfolder = os.path.join(self._metafolder,
-                                         str(gname).strip('[]').\
-                                             replace(', ','').replace('\'', ''))
-            else:
-                altfolder = self._metafolder.strip('[]').\
-                    replace(', ','').replace('\'', '')
-            if not os.path.exists(altfolder):
-                os.mkdir(altfolder)
-                
-            self.protocols[gname]=protocol(altgraphs[gname], mods,\
-                                               altfolder, self._extract_doc(leafprot))
-            #self.protocols[gname]._getGraph().toPdf(altfolder+'/graph.dot')
-            #if not os.path.exists('wdir'):
-            #    os.mkdir('wdir')
-            #if not os.path.exists('wdir/' + gname):
-            #    os.mkdir('wdir/'+gname)
-            #self.protocols[gname].setWdir('wdir/'+gname)
-
-                                        
+        self.protocols = protocolset(self._buildProtocol, altgraphs.keys())
+
+    def _altFolder(self, gname):
+        if str(gname) != '':
+            altfolder = os.path.join(self._metafolder,
+                                     str(gname).strip('[]').\
+                                         replace(', ','').replace('\'', ''))
+        else:
+            altfolder = self._metafolder.strip('[]').\
+                replace(', ','').replace('\'', '')
+        if not os.path.exists(altfolder):
+            os.mkdir(altfolder)
+        return altfolder
+
+    def _buildProtocol(self, gname):
+        log.send('Building protocol: ' + repr(gname), 2)
+        prot = protocol(self._altgraphs[gname].materialize(), self._mods,
+                        self._altFolder(gname), self._doc)
+        self._shareNodes(prot)
+        return prot
+
+    def _shareNodes(self, prot):
+        # a node not depending on the choice made in some group has
+        # the same lineage in more than one alternative protocol: it
+        # is computed once and its resource is stored in the shared
+        # folder, where the other protocols find it when they are built
+        groups = [set(x) for x in self._getNodeGroups().values()
+                  if len(x) > 1]
+        lineages = prot._getLineages()
+        sharedfolder = os.path.join(self._metafolder, '_shared')
+        for node in lineages.keys():
+            upstream = self._graph.getAncestors(node) | set([node])
+            if not any([upstream.isdisjoint(x) for x in groups]):
+                prot._unshareResource(node)
+                continue
+            if not os.path.exists(sharedfolder):
+                os.mkdir(sharedfolder)
+            path = os.path.join(sharedfolder,
+                                node + '-' + lineages[node][:12] + '.res')
+            res = self._shared.get(path)
+            if res == None:
+                res = prot._getResource(node)
+                if res.getDumpPath() != path:
+                    #results of previous builds are moved, not recomputed
+                    if not os.path.exists(path) and res.isDumped():
+                        os.replace(res.getDumpPath(), path)
+                    res = resource(node, path)
+                    res.setDumpPath(path)
+                self._shared[path] = res
+            log.send('Node ' + node + ' is shared.', 2)
+            prot._shareResource(node, res)
+
     def _getNodeGroups(self):
         nodegroups = dict()
         for node in self._graph.getNodes():
@@ -177,35 +285,25 @@ class project():
        yield []
        
     def _altPathToName(self, path):
-        return str(path).strip('[]')
+        return ', '.join(path)
 
     def _generateAltGraphs(self):
-        altpaths = self._generateAltPaths()
-        groups = self._getNodeGroups().values()
-        for path in altpaths:
-            self._altgraphs[self._altPathToName(path)] = copy.deepcopy(self._graph)
-            for group in groups:
-                for node in group:
-                    if node not in path:
-                        self._altgraphs[self._altPathToName(path)].delNode(node)
-            log.send('Alternative protocol ' + self._altPathToName(path) +
-                ' is: ' + str(self._altgraphs[self._altPathToName(path)]), 2)
-                        
+        # views of the main graph, each one masking the nodes of the
+        # groups that are not in its path
+        self._altgraphs = dict()
+        grouped = set()
+        for group in self._getNodeGroups().values():
+            grouped.update(group)
+        for path in self._generateAltPaths():
+            excluded = [x for x in grouped if not x in path]
+            self._altgraphs[self._altPathToName(path)] = \
+                graphview(self._graph, excluded)
         return self._altgraphs
 
     def _generateAltPaths(self):
+        # one node from each group
         ngroups = self._getNodeGroups()
-        temp = list()
-        combs = self._combinations(*(ngroups.values()))
-        # the following includes ugly patches because it's safer than
-        # changing self._combinations, which is cryptic. Best solution
-        # is still to change _combinations.
-        for t in combs:
-            if len(t)>0:
-                temp.append(t[0])
-            else:
-                temp.append(t)
-        return temp
+        return self._combinations(*(ngroups.values()))
         
     def _guessLeafProt(self):
         hislocals = self._getUserLocals()
@@ -258,14 +356,11 @@ class project():
         mymods=dict()
         nodenames = self._graph.getNodes()
         for nodename in nodenames:
-            modname = nodename #self._graph.getAttrib(nodename, 'bind')
-            if modname in hislocals.keys():
-                if not self._graph.getAttrib(nodename, 'bind') in hislocals:
-                    NameError('There is no '+self._graph.getAttrib(nodename, 'bind')+
-                              ' in your Python module.')
-                mymods[modname] = hislocals[self._graph.getAttrib(nodename, 'bind')]
-                #mymods[modname] = hislocals[modname]
-
+            modname = self._graph.getAttrib(nodename, 'bind') or nodename
+            if self._graph.getAttrib(nodename, 'gather') != None:
+                mymods[nodename] = lgl.gather
+            elif modname in hislocals.keys():
+                mymods[nodename] = hislocals[modname]
             else:
                 raise NameError('I couldn''t bind '+modname+' to any of your defined objects.')
 
@@ -289,18 +384,46 @@ class project():
         g = self._seekforProt(self._protName)
         self._updateGraphs(g)
             
-    def run(self):
-        """Calls run on all protocols of the project."""
+    def run(self, parallel=False, max_workers=None):
+        """Calls run on all protocols of the project.
+
+        If parallel is True, the alternative protocols are built
+        together, through a single schedule over a shared pool of at
+        most max_workers workers.
+        """
+        if parallel and len(self.protocols) > 1:
+            log.insertBreak()
+            log.send('Running instances: ' +
+                     ', '.join([repr(x) for x in self.protocols.keys()]))
+            merged = protocol.__new__(protocol)
+            merged._merge(self.protocols, self._metafolder)
+            for attr, pool in self._pools.items():
+                setattr(merged, attr, pool)
+            try:
+                merged.run(parallel, max_workers)
+            finally:
+                #pools are kept by the project for its next runs, not
+                #by the protocols, which have pools of their own
+                self._pools = dict([(x, getattr(merged, x)) for x in
+                                    ['_pool', '_threads', '_looppool']])
+            return
         for protname in self.protocols.keys():
             log.insertBreak()
             log.send('Running instance: ' + protname)
-            self.protocols[protname].run()
+            self.protocols[protname].run(parallel, max_workers)
             
+    def closePool(self):
+        """Stops the workers shared by parallel runs of the project."""
+        for attr in ['_pool', '_threads']:
+            if self._pools.get(attr) != None:
+                self._pools[attr].shutdown()
+        self._pools = dict()
+
     def listProtocols(self):
         """Lists the names of all the protocols of the project."""
         for protname in self.protocols:
             log.send('- ' + protname, 0)            
-            log.send('  ' + str(self.protocols[protname]._getGraph()))
+            log.send('  ' + str(self._altgraphs[protname]))
             
     # def getProtocol(self, protname):
     #     return self.protocols[protname]
@@ -325,6 +448,8 @@ class project():
 #        return fname
 
     protocols = dict()
+    _shared = dict()
+    _pools = dict()
     _graph = graph()
     _name = ''
     _metafolder = ''
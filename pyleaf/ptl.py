@@ -23,8 +23,14 @@
 import os
 import pickle
 import inspect
+import threading
 from pyleaf.log import send as dbgstr
-from pyleaf.rrc import resource
+from pyleaf.rrc import resource, getCodec, checkCompression
+from pyleaf.sch import scheduler, workerpool, threadpool, looppool, \
+    unpackResult, makeParam, dumpedinput, dumpedresult, parseSize, \
+    refcounter, freeze, makeFrozenParam, inputDigests, checkInputs, thaw, \
+    mapItems, pipeline, isStream, drainStream, sharedresult, discardResult
+from pyleaf.gph import dotId
 import copy
 import inspect
 import time        
@@ -48,7 +54,8 @@ class protocol():
     as the files NODENAME.res. The files NODENAME.mod within the same
     directory are used to store nodes source code. All the data in
     these files are wrapped in leaf.rrc.resource objects which dump
-    themselves through the pickle.dump method. Other files in the
+    themselves through pickle, followed by their value written by a
+    codec (see setCodec). Other files in the
     directory are produced by the leaf.prj.project class.
     
     """    
@@ -59,7 +66,12 @@ class protocol():
         dbgstr('Initializing protocol with root: ' + folder)
         self._metafolder = folder
         self._rootdir = os.getcwd()
+        self._buildlock = threading.RLock()
         self._resmap = dict()
+        self._executors = dict()
+        self._maps = dict()
+        self._codecs = dict()
+        self._compressions = dict()
         self._doc = doc
 
         self._graphres = resource('graph', os.path.join(folder,'graph.grp'))
@@ -96,9 +108,13 @@ class protocol():
     def _updateGraph(self, graph):
         self._graphres.setValue(graph)
         untrustme1 = list()
-        if self._graphres.changed():
-            if self._graphres.isDumped():
-                untrustme1 = self._manageGraphChange(self._graphres.getFingerprint())
+        if self._graphres.isDumped() and \
+                self._graphres.getFingerprint() != None:
+            untrustme1 = self._manageGraphChange(self._graphres.getFingerprint())
+            if len(untrustme1) > 0:
+                #attribute changes are not seen by the resource
+                self._graphres.updateFingerprint()
+                self._graphres.dump()
         self._graphres.update()
         return untrustme1
 
@@ -143,17 +159,22 @@ class protocol():
                 os.rmdir(self._metafolder)
 
     def getinputs(self, mod):
-        """Collects all input resources that are input to the given filter and returns a copy of them in a list."""
+        """Collects all input resources that are input to the given filter and returns a copy of them in a list.
+
+        In zero-copy mode, read-only views of the resources are returned instead of copies."""
         if type(mod) != str:
             mod = mod.__name__
 
         innodes = self._getInNodes(mod)
         ids = [self._getGraph().getAttrib(_node, 'id') for _node in innodes]
-        nodeparams = [copy.deepcopy(self._getResource(innode).getValue()) for innode in innodes]
+        if self._zerocopy:
+            nodeparams = [freeze(self._provideResource(innode).getValue()) for innode in innodes]
+        else:
+            nodeparams = [copy.deepcopy(self._provideResource(innode).getValue()) for innode in innodes]
         nodeparams=[one for (one,two) in sorted(zip(nodeparams, ids), key = lambda x:x[1])]      
         return tuple(nodeparams)
 
-    def run(self, parallel = False):
+    def run(self, parallel = False, max_workers = None):
         """Provides all leaf (final) resources."""
         res = None
         allok = True
@@ -166,7 +187,7 @@ class protocol():
         if allok:
             dbgstr('Nothing to be done. Zzz...')
         else:
-            res = self.provide(l, parallel)
+            res = self.provide(l, parallel, max_workers)
         return res
     
     def untrust(self, nodename):
@@ -197,6 +218,7 @@ class protocol():
             dbgstr('Resetting resource: ' + str(filtername))
         self.clear(filtername, False)
         self.undump(filtername, False)
+        self._forgetRemote(filtername)
 
     def undump(self, filtername, verbose = True):
         """Undumps a resource (removes cached version from disk)."""
@@ -277,7 +299,7 @@ class protocol():
             else:
                 shape = 'box'
 
-            f.write(str(node))
+            f.write(dotId(node))
             docstr = inspect.getdoc(self._modules[node].getValue()) if type(self._modules[node].getValue())==type(inspect.getdoc) else None
             f.write('[shape = ' + shape + ', label = <<table border="0"><tr><td><B>' +
                     self._getGraph().getAttrib(node, 'label') +
@@ -286,7 +308,7 @@ class protocol():
                     '</font></td></tr></table>>]\n')
         for node in self._getGraph().keys():
             for onode in self._getGraph()[node]:
-                f.write(node + ' -> ' + onode + '\n')
+                f.write(dotId(node) + ' -> ' + dotId(onode) + '\n')
         f.write('}')
         f.close()
         t=os.system('dot -Tpdf -o' + ofile + '.pdf ' + ofile)
@@ -317,7 +339,7 @@ class protocol():
                 ('TB' if layout.lower()=='tb' else 'LR')+
                 ';\n')
         for idx, node in enumerate(self._getGraph().getNodes()):
-            f.write(str(node))
+            f.write(dotId(node))
             docstr = inspect.getdoc(self._modules[node].getValue()) if type(self._modules[node].getValue())==type(inspect.getdoc) else None
 
             if self._isFileMod(node):
@@ -353,7 +375,7 @@ class protocol():
                     '</table>>]\n')
         for node in self._getGraph().keys():
             for onode in self._getGraph()[node]:
-                f.write(node + ' -> ' + onode + '\n')
+                f.write(dotId(node) + ' -> ' + dotId(onode) + '\n')
         f.write('}')
         f.close()
         t=os.system('dot -s160 -Tcmapx -o' +
@@ -465,9 +487,169 @@ class protocol():
     def _prettyPrint(self, x):
         return str(x).strip('[]').replace("'","")
 
-    def provide(self, res, parallel=False):
-        t = time.time()
+    def setPool(self, max_workers=None, max_tasks=None, start_method=None):
+        """Configures the pool of workers used by parallel builds.
+
+        max_workers bounds the number of nodes running at the same
+        time (default is the number of CPUs). If max_tasks is given,
+        each worker is replaced after running that many nodes.
+
+        start_method is the multiprocessing start method of the
+        workers (default is the one of the platform). With 'fork',
+        replaced workers are forked while the build is running:
+        workers are not replaced if the build also runs threads
+        (nodes in threads, on the event loop, streaming or remote, or
+        builds started by provide_async). Use 'forkserver' to replace
+        them anyway: as with 'spawn', the user module must then be
+        importable and scripts must run the build under
+        if __name__ == '__main__'.
+        """
+        if start_method != None:
+            import multiprocessing
+            if not start_method in multiprocessing.get_all_start_methods():
+                raise NameError('Unknown start method: ' + str(start_method))
+        self.closePool()
+        self._maxworkers = max_workers
+        self._maxtasks = max_tasks
+        self._startmethod = start_method
+
+    def closePool(self):
+        """Stops the workers used by parallel builds."""
+        if self._pool != None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._threads != None:
+            self._threads.shutdown()
+            self._threads = None
+
+    def setExecutor(self, node, executor):
+        """Selects where a node runs during parallel builds.
+
+        executor can be 'inline' (in the calling process, one node at
+        a time), 'thread' (in a shared thread pool, inputs are not
+        copied), 'process' (in the worker pool, the default) or
+        'remote' (on the workers of setCluster). The
+        same can be set through the LGL node attribute
+        executor. If node is None, the default for all nodes is set.
+        """
+        if type(node) != str and node != None:
+            node = node.__name__
+        if not executor in self._executorKinds:
+            raise NameError('Unknown executor: ' + str(executor) +
+                            '. Use one of: ' +
+                            self._prettyPrint(self._executorKinds))
+        self._executors[node] = executor
+
+    def setCodec(self, node, codec):
+        """Selects how the resource of a node is written to disk.
+
+        codec is the name of one of the codecs in pyleaf.rrc.codecs:
+        'pickle5' (pickle with large buffers written out-of-band),
+        'npy' (a NumPy array), 'npz' (a dict of NumPy arrays), 'raw'
+        (bytes or bytearray), 'pickle', or 'auto' (the default, which
+        chooses one by the type of the value). The same can be set
+        through the LGL node attribute codec. If node is None, the
+        default for all nodes is set.
+        """
+        if type(node) != str and node != None:
+            node = node.__name__
+        getCodec(codec)
+        self._codecs[node] = codec
+
+    def _getCodec(self, node):
+        if self._codecs.get(node) != None:
+            return self._codecs[node]
+        if self._getGraph().getAttrib(node, 'codec') != None:
+            return self._getGraph().getAttrib(node, 'codec')
+        return self._codecs.get(None) or 'auto'
+
+    def setCompression(self, node, method):
+        """Selects the compression of the resource of a node on disk.
+
+        method can be None (no compression, the default), 'zlib',
+        'bz2', 'lzma' or 'auto', which compresses with zlib only
+        values whose first bytes do compress well. Values are
+        compressed while they are written. The same can be set through
+        the LGL node attribute compress. If node is None, the default
+        for all nodes is set.
+        """
+        if type(node) != str and node != None:
+            node = node.__name__
+        checkCompression(method)
+        self._compressions[node] = method
+
+    def _getCompression(self, node):
+        if node in self._compressions:
+            return self._compressions[node]
+        method = self._getGraph().getAttrib(node, 'compress')
+        if method != None:
+            return None if method == 'none' else method
+        return self._compressions.get(None)
+
+    def mapOn(self, node, chunksize=1):
+        """Switches map mode ON for a node.
+
+        A node whose inputs are passed separately (no hash attribute)
+        is applied to each element of its inputs, and the results are
+        collected in a list resource, in the same order. During
+        parallel builds the elements are scattered over the pool of
+        the node's executor, chunksize at a time. The same can be set
+        through the LGL node attributes map=true and chunk.
+        """
+        if type(node) != str:
+            node = node.__name__
+        self._maps[node] = chunksize
+
+    def mapOff(self, node):
+        """Switches map mode OFF for a node."""
+        if type(node) != str:
+            node = node.__name__
+        self._maps[node] = None
+
+    def provide(self, res, parallel=False, max_workers=None):
+        """Provides one resource or a list of resources."""
+        res = self._getTargets(res)
+        with self._buildlock:
+            builtres = self._provide(res, parallel, max_workers)
+
+        if len(builtres) > 1:
+            return builtres
+        else:
+            return builtres[0]
+
+    def provide_async(self, res, parallel=False, max_workers=None):
+        """Provides resources without waiting for them to be built.
+
+        Returns a concurrent.futures.Future for each requested
+        resource (a single one if only one was requested). Each future
+        is resolved as soon as its resource is available. Builds
+        requested this way run one at a time in a background thread,
+        and never together with those requested through provide.
+        """
+        futures = self._provideAsync(res, parallel, max_workers, None)
+        if len(futures) > 1:
+            return futures
+        else:
+            return futures[0]
+
+    async def aprovide(self, res, parallel=False, max_workers=None):
+        """Coroutine version of provide.
 
+        Nodes defined through "async def" are run on the event loop
+        of the caller.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        futures = self._provideAsync(res, parallel, max_workers, loop)
+        builtres = await asyncio.gather(
+            *[asyncio.wrap_future(future) for future in futures])
+
+        if len(builtres) > 1:
+            return list(builtres)
+        else:
+            return builtres[0]
+
+    def _getTargets(self, res):
         if not type(res) == list:
             temp = list()
             temp.append(res)
@@ -476,73 +658,614 @@ class protocol():
         for i,r in enumerate(res):
             if type(res[i]) != str:
                 res[i] = res[i].__name__
+        return res
+
+    def _provideAsync(self, res, parallel, max_workers, loop):
+        from concurrent.futures import Future, ThreadPoolExecutor
+        res = self._getTargets(res)
+        futures = dict()
+        for resname in res:
+            futures[resname] = Future()
+
+        if self._driver == None:
+            self._driver = ThreadPoolExecutor(1)
+        self._driver.submit(self._provideFutures, res, parallel,
+                            max_workers, loop, futures)
+        return [futures[resname] for resname in res]
+
+    def _provideFutures(self, res, parallel, max_workers, loop, futures):
+        def ondone(node):
+            if node in futures and not futures[node].done():
+                futures[node].set_result(
+                    self._provideResource(node).getValue())
+
+        #builds requested through provide wait for this one
+        with self._buildlock:
+            self._activeloop = loop
+            try:
+                self._provide(res, parallel, max_workers, ondone)
+                for resname in res:
+                    ondone(resname)
+            except BaseException as e:
+                for future in futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                self._activeloop = None
+
+    def _provide(self, res, parallel, max_workers, ondone=None):
+        t = time.time()
 
         D = self._findDependancies(res)
         D.update(res)
         states = self._getBestStates(D)
 
+        #dumped inputs are loaded only when a node needs them
+        states = (states[0], [x for x in states[1] if x in res],
+                  states[2])
+
         if len(states[1]) > 0:
             dbgstr('The following resources will be loaded from disk: '+
                    self._prettyPrint(states[1]))
             for node in states[1]:
                 self._provideResource(node)
 
+        if ondone != None:
+            for node in states[0] + states[1]:
+                ondone(node)
+
         if len(states[2]) > 0:
             dbgstr('The following resources will need production: '+
                    self._prettyPrint(states[2]))
-        needbuild = states[2]
-
-        while True:
-            canrun = self._findRunnable(needbuild)
-            if len(canrun) > 1 and parallel:
-                dbgstr('The following nodes can run in parallel: '+
-                       self._prettyPrint(canrun))
-
-            self._runNodes(canrun, parallel)
-            needbuild=[x for x in needbuild if not x in canrun]
-
-            if len(canrun)==0:
-                break
+        sched = scheduler(self._getGraph(), states[2],
+                          self._estimateTimes(states[2]))
+        refs = refcounter(self._getGraph(), states[2])
+        self._runNodes(sched, parallel, max_workers, ondone, refs, res)
 
         builtres = list()
         for resname in res:
-            builtres.append(self._resmap[resname].getValue())
+            builtres.append(self._provideResource(resname).getValue())
 
         if len(states[1]) > 0 or len(states[2]) > 0:
             dbgstr('Done in: ' + self._readabletime(time.time() - t) + '.')
 
-        if len(builtres) > 1:
-            return builtres
-        else:
-            return builtres[0]
+        return builtres
 
-    def _runNodes(self, nodes, parallel = False):
-        if parallel and len(nodes)>1:
-            from multiprocessing import Process, Queue
-            results = Queue()
-            tasks = list()
-            for node in nodes:
-                nodeparams = self._getNodePar(node)
-                tasks.append(
-                    Process(target=self._callModPar, args=(node, nodeparams, results,))
-                    )
-            for task in tasks: task.start()
-            for task in tasks: task.join()
+    def _estimateTimes(self, nodes):
+        # build times recorded during previous builds; nodes that never
+        # ran are expected to take the average time of the others
+        known = [self._resmap[x]._buildtime for x in self._getResNames()
+                 if self._resmap[x]._buildtime != None]
+        if len(known) > 0:
+            default = sum(known) / len(known)
+        else:
+            default = 1.0
+        times = dict()
+        for node in nodes:
+            t = self._getResource(node)._buildtime
+            times[node] = default if t == None else t
+        return times
+
+    def _runNodes(self, sched, parallel = False, max_workers = None,
+                  ondone = None, refs = None, keep = ()):
+        # nodes are started as soon as all of their inputs are
+        # available, without waiting for unrelated nodes to finish
+        if ondone == None:
+            ondone = lambda node: None
+        if refs == None:
+            refs = refcounter(self._getGraph(), [])
+
+        if not parallel:
+            while sched.hasReady():
+                node = sched.nextReady()
+                if self._getExecutor(node) == 'stream':
+                    pipe, members = self._startPipeline(node, sched, refs,
+                                                        keep)
+                    results, errors = pipe.run()
+                    self._endPipeline(members, results, errors, sched,
+                                      ondone, refs, keep)
+                    if len(errors) > 0:
+                        raise list(errors.values())[0]
+                    continue
+                self._runReadyNode(node)
+                self._evictInputs(refs, node, keep)
+                sched.setDone(node)
+                ondone(node)
+                self._evictUnused(refs, node, keep)
+            return
 
+        from concurrent.futures import wait, FIRST_COMPLETED
+        executors = set([self._getExecutor(node)
+                         for node in sched.unfinished()])
+        threaded = len(executors & set(['thread', 'async', 'stream',
+                                        'remote'])) > 0
+        pools = dict()
+        pools['process'] = lambda: self._getPool(max_workers, threaded)
+        pools['thread'] = lambda: self._getThreads(max_workers)
+        pools['async'] = self._getLoopPool
+        pools['remote'] = self._getCluster
+        if max_workers == None:
+            max_workers = self._maxworkers or os.cpu_count() or 1
+        if 'process' in executors:
+            #started before the helper threads of this build
+            pools['process']()
+        running = dict.fromkeys(pools, 0)
+        running['stream'] = 0
+        pipes = dict()
+        budget = self._getBudget(max_workers)
+        used = [0, 0]
+        needs = dict()
+
+        def canrun(node):
+            executor = self._getExecutor(node)
+            if executor in ['async', 'stream']:
+                return True
+            if executor == 'remote':
+                #remote nodes don't use the local budget
+                return running[executor] < max(1, self._getCluster().size())
+            if executor != 'inline' and running[executor] >= max_workers:
+                return False
+            if len(tasks) == 0:
+                #a node exceeding the whole budget still runs alone
+                return True
+            cpus, mem = self._getRequirements(node)
+            if used[0] + cpus > budget[0]:
+                return False
+            return budget[1] == None or used[1] + mem <= budget[1]
+
+        tasks = dict()
+        failures = list()
+        try:
+            while not sched.finished():
+                node = sched.nextReady(canrun)
+                while node != None:
+                    executor = self._getExecutor(node)
+                    if executor == 'inline':
+                        try:
+                            self._runReadyNode(node)
+                        except Exception as e:
+                            self._nodeFailed(failures, sched, [node], e)
+                            node = sched.nextReady(canrun)
+                            continue
+                        self._evictInputs(refs, node, keep)
+                        sched.setDone(node)
+                        ondone(node)
+                        self._evictUnused(refs, node, keep)
+                    else:
+                        dbgstr('Starting ' + node +
+                               ' (expected remaining time: ' +
+                               self._readabletime(sched.getPriority(node)) +
+                               ').', 2)
+                        if len(tasks) > 0:
+                            dbgstr('Starting ' + node + ' while running: ' +
+                                   self._prettyPrint(sorted(tasks.values())))
+                        funct = self._modules[node].getValue()
+                        chunksize = self._getMapChunk(node)
+                        if executor == 'stream':
+                            pipe, pipes[node] = self._startPipeline(
+                                node, sched, refs, keep)
+                            task = pipe.start()
+                        elif chunksize != None:
+                            items = mapItems(self._getNodePar(node))
+                            dbgstr('Scattering ' + str(len(items)) +
+                                   ' items for: ' + node, 2)
+                            task = pools[executor]().map(node, funct, items,
+                                                         chunksize)
+                        elif executor == 'process':
+                            nodeparams = self._getNodePar(node, True)
+                            task = pools[executor]().submit(
+                                node, funct, nodeparams,
+                                self._getResource(node).getDumpPath()
+                                if self._dodump else None,
+                                self._getCodec(node),
+                                self._getCompression(node),
+                                self._getResource(node).getStreamPath())
+                        elif executor == 'remote':
+                            task = pools[executor]().submit(
+                                node, funct, self._getNodePar(node),
+                                self._getInNodes(node))
+                        elif executor == 'thread':
+                            nodeparams = self._getNodePar(node)
+                            task = pools[executor]().submit(
+                                node, funct, nodeparams, self._checkinputs)
+                        else:
+                            nodeparams = self._getNodePar(node)
+                            task = pools[executor]().submit(
+                                node, funct, nodeparams)
+                        tasks[task] = node
+                        running[executor] += 1
+                        self._evictInputs(refs, node, keep)
+                        if executor in ['async', 'stream', 'remote']:
+                            needs[node] = (0, 0)
+                        else:
+                            needs[node] = self._getRequirements(node)
+                        used[0] += needs[node][0]
+                        used[1] += needs[node][1]
+                    node = sched.nextReady(canrun)
+
+                if len(tasks) == 0:
+                    continue
+                done, notdone = wait(tasks, return_when=FIRST_COMPLETED)
+                for task in done:
+                    node = tasks.pop(task)
+                    running[self._getExecutor(node)] -= 1
+                    used[0] -= needs[node][0]
+                    used[1] -= needs.pop(node)[1]
+                    if task.exception() != None:
+                        #results of the other nodes are still collected
+                        self._nodeFailed(failures, sched,
+                                         pipes.pop(node, [node]),
+                                         task.exception())
+                        continue
+                    if node in pipes:
+                        results, errors = task.result()
+                        self._endPipeline(pipes.pop(node), results, errors,
+                                          sched, ondone, refs, keep)
+                        for member in errors:
+                            self._nodeFailed(failures, sched, [member],
+                                             errors[member])
+                        continue
+                    newres, t = task.result()
+                    try:
+                        if isinstance(newres, dumpedresult):
+                            self._newDumpedResource(node, newres)
+                        else:
+                            peakmem = None
+                            if isinstance(newres, sharedresult):
+                                #measured by the worker process
+                                peakmem = newres.peakmem
+                            newres = unpackResult(newres)
+                            dbgstr('Requesting add resource: ' + node, 2)
+                            self._newResource(
+                                self._buildResName(node, None, newres),
+                                newres, t, peakmem)
+                            if self._getExecutor(node) == 'remote':
+                                self._cluster.keep(task, node)
+                    except Exception as e:
+                        #a result that can't be stored fails its node
+                        self._getResource(node).clear()
+                        self._nodeFailed(failures, sched, [node], e)
+                        continue
+                    sched.setDone(node)
+                    ondone(node)
+                    self._evictUnused(refs, node, keep)
+        finally:
+            #results still in flight are not collected: the files
+            #holding them are removed as soon as they arrive
             for task in tasks:
-                taskres = results.get()
-                resname = self._buildResName(taskres[0], None, taskres[1])
-                dbgstr('Requesting add resource: ' + taskres[0], 2)
-                t=taskres[2]
-                self._newResource(resname, taskres[1], t)
-        else:
-            for node in nodes:
-                nodeparams = self._getNodePar(node)
-                taskres = self._callMod(node, nodeparams)
-                resname = self._buildResName(taskres[1], None, taskres[0])
-                dbgstr('Requesting add resource: ' + resname, 2)
-                t=taskres[2]
-                self._newResource(resname, taskres[0], t)
+                task.add_done_callback(discardResult)
+
+        if len(failures) > 0:
+            self._reportFailures(failures, sched)
+
+    def _nodeFailed(self, failures, sched, nodes, error):
+        import traceback
+        trace = ''.join(traceback.format_exception(
+            type(error), error, error.__traceback__))
+        for node in nodes:
+            dbgstr('Node ' + node + ' failed: ' + str(error))
+            sched.setFailed(node)
+            failures.append((node, trace))
+
+    def _reportFailures(self, failures, sched):
+        # completed nodes have been stored: a new build resumes from
+        # the failed ones
+        failed = [node for node, trace in failures]
+        skipped = [node for node in sched.unfinished() if not node in failed]
+        msg = 'Build failed at: ' + self._prettyPrint(failed) + '.'
+        if len(skipped) > 0:
+            msg += ' Not built: ' + self._prettyPrint(sorted(skipped)) + '.'
+        for node, trace in failures:
+            msg += '\n\n' + node + ':\n' + trace
+        raise NameError(msg)
+
+    def _isStreaming(self, node):
+        return inspect.isgeneratorfunction(self._modules[node].getValue())
+
+    def _acceptsStream(self, node):
+        funct = self._modules[node].getValue()
+        if getattr(funct, 'leaf_streams', False):
+            return True
+        return str(self._getGraph().getAttrib(node, 'stream')).lower() == 'true'
+
+    def _getPipeline(self, node, sched):
+        # the streaming node and, recursively, the consumers that can
+        # start with it: those accepting streams and having all their
+        # other inputs ready. A consumer streaming from two members
+        # would share an upstream producer with itself and could
+        # stall it by reading one stream before the other: it is run
+        # later on the stored streams instead.
+        members = [node]
+        for member in members:
+            if not self._isStreaming(member):
+                continue
+            for onode in self._getGraph().getOutNodes(member):
+                if (onode in members or not sched.isPending(onode) or
+                    not self._acceptsStream(onode)):
+                    continue
+                innodes = self._getInNodes(onode)
+                if len([x for x in innodes if x in members]) > 1:
+                    continue
+                if all([x in members or sched.isDone(x) for x in innodes]):
+                    members.append(onode)
+        return members
+
+    def _startPipeline(self, node, sched, refs, keep):
+        members = self._getPipeline(node, sched)
+        if len(members) > 1:
+            dbgstr('Streaming ' + node + ' to: ' +
+                   self._prettyPrint(members[1:]))
+        pipe = pipeline(self._queuesize)
+        for member in members:
+            if member != node:
+                sched.claim(member)
+            nodeparams = list()
+            for innode in self._getInNodes(member):
+                if innode in members:
+                    nodeparams.append(pipe.connect(innode))
+                else:
+                    nodeparams.append(self._makeParam(
+                        self._provideResource(innode).getValue()))
+            self._addShard(member, nodeparams)
+            pipe.add(member, self._modules[member].getValue(), nodeparams,
+                     self._getResource(member).getStreamPath())
+        for member in members:
+            self._evictInputs(refs, member, keep)
+        return pipe, members
+
+    def _endPipeline(self, members, results, errors, sched, ondone, refs,
+                     keep):
+        # members whose results can't be stored are added to errors
+        for member in members:
+            if not member in results:
+                continue
+            newres, t = results[member]
+            dbgstr('Requesting add resource: ' + member, 2)
+            try:
+                self._newResource(member, newres, t)
+            except Exception as e:
+                self._getResource(member).clear()
+                errors[member] = e
+                continue
+            sched.setDone(member)
+            ondone(member)
+            self._evictUnused(refs, member, keep)
+
+    def setQueueSize(self, size):
+        """Sets how many chunks a streaming node can produce ahead of
+        its slowest consumer before being paused."""
+        self._queuesize = size
+
+    def evictOn(self):
+        """Switches eviction ON.
+
+        While building, intermediate resources are cleared from RAM as
+        soon as they are dumped and all the nodes reading them have
+        started. Requested resources are kept. Only effective if
+        dumping is ON.
+        """
+        self._doevict = True
+
+    def evictOff(self):
+        """Switches eviction OFF."""
+        self._doevict = False
+
+    def zeroCopyOn(self):
+        """Switches zero-copy inputs ON.
+
+        Nodes running in the protocol process (serial builds, inline
+        and thread executors) receive their inputs without any copy:
+        lists as read-only sequences, dicts as read-only mappings and
+        NumPy arrays as non-writeable views. getinputs returns the
+        same views instead of deep copies.
+        """
+        self._zerocopy = True
+
+    def zeroCopyOff(self):
+        """Switches zero-copy inputs OFF."""
+        self._zerocopy = False
+
+    def checkInputsOn(self):
+        """Switches input checking ON.
+
+        Debugging aid: an error is raised if a node running in the
+        protocol process modifies its inputs.
+        """
+        self._checkinputs = True
+
+    def checkInputsOff(self):
+        """Switches input checking OFF."""
+        self._checkinputs = False
+
+    def _evictInputs(self, refs, node, keep):
+        for innode in refs.release(node):
+            self._evict(innode, keep)
+
+    def _evictUnused(self, refs, node, keep):
+        if refs.isUnused(node):
+            self._evict(node, keep)
+
+    def _evict(self, resname, keep):
+        if not self._doevict or not self._dodump or resname in keep:
+            return
+        if self._isAvailable(resname) and self._isDumped(resname):
+            dbgstr('Evicting resource from RAM: ' + str(resname), 2)
+            self.clear(resname, False)
+            self._forgetRemote(resname)
+
+    def setBudget(self, cpus=None, mem=None):
+        """Sets the resources available to parallel builds.
+
+        Nodes are started only if the CPU slots and the memory they
+        need, added to those of the running nodes, fit within the
+        budget. cpus defaults to max_workers, mem (bytes or a string
+        like "16G") to the physical memory of the machine. The needs
+        of a node are declared through the LGL attributes cpus and
+        mem or the pyleaf.sch.requires decorator. Otherwise one CPU
+        slot and the peak memory measured during its last build are
+        assumed.
+        """
+        self._budget = (cpus, parseSize(mem))
+
+    def _getBudget(self, max_workers):
+        cpus, mem = self._budget
+        if cpus == None:
+            cpus = max_workers
+        if mem == None:
+            try:
+                mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            except (ValueError, AttributeError):
+                mem = None
+        return cpus, mem
+
+    def _getRequirements(self, node):
+        funct = self._modules[node].getValue()
+        declared = dict(getattr(funct, 'leaf_requires', dict()))
+        for key in ['cpus', 'mem']:
+            if declared.get(key) == None:
+                declared[key] = self._getGraph().getAttrib(node, key)
+        cpus = 1 if declared['cpus'] == None else int(declared['cpus'])
+        mem = parseSize(declared['mem'])
+        if mem == None:
+            mem = self._getResource(node)._peakmem or 0
+        return cpus, mem
+
+    def _getLoopPool(self):
+        if self._activeloop != None:
+            return looppool(self._activeloop)
+        if self._looppool == None:
+            self._looppool = looppool()
+        return self._looppool
+
+    def _awaitResult(self, newres):
+        if inspect.iscoroutine(newres):
+            dbgstr('Waiting for coroutine on the event loop.', 2)
+            newres = self._getLoopPool().run(newres)
+        return newres
+
+    def _getMapChunk(self, node):
+        # chunk size for nodes in map mode, None for the others
+        if self._getGraph().getAttrib(node, 'hash'):
+            return None
+        if node in self._maps:
+            return self._maps[node]
+        chunk = self._getGraph().getAttrib(node, 'chunk')
+        if chunk != None:
+            return int(chunk)
+        if str(self._getGraph().getAttrib(node, 'map')).lower() == 'true':
+            return 1
+        return None
+
+    def _getExecutor(self, node):
+        if not self._checkIsFunction(self._modules[node].getValue()):
+            return 'inline'
+        if self._isStreaming(node):
+            return 'stream'
+        if inspect.iscoroutinefunction(self._modules[node].getValue()):
+            return 'async'
+        if node in self._executors:
+            return self._executors[node]
+        executor = self._getGraph().getAttrib(node, 'executor')
+        if executor != None:
+            if not executor in self._executorKinds:
+                raise NameError('Unknown executor for node ' + node +
+                                ': ' + str(executor))
+            return executor
+        if None in self._executors:
+            return self._executors[None]
+        if self._cluster != None:
+            return 'remote'
+        return 'process'
+
+    def _getThreads(self, max_workers):
+        if self._threads != None and not self._threads.matches(max_workers):
+            self._threads.shutdown()
+            self._threads = None
+        if self._threads == None:
+            if max_workers == None:
+                max_workers = self._maxworkers
+            self._threads = threadpool(max_workers)
+        return self._threads
+
+    def _getPool(self, max_workers, threaded=False):
+        # threads of the protocol running while workers are replaced:
+        # those of the build (threaded) and of the other helpers, or
+        # the calling thread itself if it's not the main one
+        import threading
+        threaded = (threaded or self._threads != None or
+                    self._looppool != None or self._cluster != None or
+                    threading.current_thread() is not threading.main_thread())
+        if self._pool != None and \
+                not self._pool.matches(max_workers, self._maxtasks, threaded):
+            self._pool.shutdown()
+            self._pool = None
+        if self._pool == None:
+            if max_workers == None:
+                max_workers = self._maxworkers
+            self._pool = workerpool(max_workers, self._maxtasks,
+                                    self._getModNames(), self._startmethod,
+                                    threaded)
+        return self._pool
+
+    def _getModNames(self):
+        return set([self._modules[node].getValue().__module__
+                    for node in self._getNodeNames()
+                    if self._checkIsFunction(self._modules[node].getValue())])
+
+    def _getCluster(self):
+        if self._cluster == None:
+            raise NameError('No cluster has been set: use setCluster.')
+        return self._cluster
+
+    def setCluster(self, address=('localhost', 0), authkey=None):
+        """Runs nodes on pyleaf workers connecting from other hosts.
+
+        A coordinator is started, listening on address: a (host, port)
+        tuple for TCP or the path of a Unix socket. Workers are started
+        on each host with:
+
+            pyleaf-worker host:port [-n WORKERS] [-k AUTHKEY]
+
+        and must be able to import the user module (see its --path
+        option). Nodes that would run in the local worker pool are
+        sent to the workers instead, preferring the ones holding their
+        inputs. The same can be chosen for single nodes with executor
+        'remote'. Returns the address actually listened on.
+
+        Workers authenticate with authkey, which defaults to
+        $PYLEAF_AUTHKEY. Without one, a random key is generated and
+        printed: anyone knowing the key can run code on this host.
+        """
+        from pyleaf.wrk import clusterpool, getKey
+        self.closeCluster()
+        paths = set([os.path.dirname(os.path.abspath(sys.modules[x].__file__))
+                     for x in self._getModNames()
+                     if getattr(sys.modules.get(x), '__file__', None)])
+        self._cluster = clusterpool(address, authkey, self._getModNames(),
+                                    paths)
+        if authkey == None and getKey() == None:
+            dbgstr('Workers must authenticate with key: ' +
+                   self._cluster.authkey().decode())
+        return self._cluster.address()
+
+    def _forgetRemote(self, resname):
+        # copies of resname held by remote workers are outdated
+        if self._cluster != None:
+            self._cluster.forget(resname)
+
+    def closeCluster(self):
+        """Stops the workers connected through setCluster."""
+        if self._cluster != None:
+            self._cluster.shutdown()
+            self._cluster = None
+
+    def _runReadyNode(self, node):
+        nodeparams = self._getNodePar(node)
+        taskres = self._callMod(node, nodeparams)
+        resname = self._buildResName(taskres[1], None, taskres[0])
+        dbgstr('Requesting add resource: ' + resname, 2)
+        t=taskres[2]
+        self._newResource(resname, taskres[0], t)
 
     def time(self, node):
         if type(node) != str:
@@ -550,15 +1273,6 @@ class protocol():
         return(self._resmap[node]._timestamp,
                self._resmap[node]._buildtime)
 
-    def _findRunnable(self, nodes):
-        #finds nodes whose inputs are available
-        runnable = list()
-        #import pdb; pdb.set_trace()
-        for node in nodes:
-            if all([self._isAvailable(n) for n in self._getInNodes(node)]):
-                runnable.append(node)
-        return runnable
-        
     def _getBestStates(self, D):
         # categorizes resources to reflect best state. I.e., if a resource is
         # both available and dumped, it is returned in the set of available resources.
@@ -603,36 +1317,28 @@ class protocol():
         return untrustme
                 
 
-    def _manageGraphChange(self, newGraph):
-        if newGraph==None:
-            return
-        #checking for change in graph structure
-        #a node is flagged as to-be-untrustest if its inputs have changed
-        #not untrusted on the fly because of dependancies with untrusts
-        #from source code changes
-        oldg = self._graphres.getValue()
+    def _manageGraphChange(self, oldg):
+        #the nodes whose results are affected by the change in the
+        #graph, with the reasons, are kept for listchanges. Only the
+        #topmost ones are returned: untrusting them also untrusts their
+        #dependents. They are not untrusted on the fly because of
+        #dependancies with untrusts from source code changes
+        self._changes = self._graphres.getValue().diff(oldg)
         untrustme = list()
-#        import pdb; pdb.set_trace()
-
-        for node in newGraph.getNodes():
-            #check wether node is (not) new
-            if node in oldg.getNodes():
-                #check if node inputs have changed
-                innodes1 = newGraph.getInNodes(node)
-                innodes2 = oldg.getInNodes(node)
-                for inNode in innodes1:
-                    if not inNode in innodes2:
-                        dbgstr('Inputs to ' + node + ' have changed, untrusting it.')
-                        untrustme.append(node)
-                #check if node properties have changed                
-                #cycling through attrib names of node 'node'
-                # for attrib in [a[1] for a in newGraph._nodeattribs if a[0]==node]:
-                #     if newGraph.getAttrib(node, attrib) != oldg.getAttrib(node, attrib):
-                #         dbgstr('Node attribs of ' + node +
-                #                ' have changed, untrusting it.')
-                #         untrustme.append(node)                        
-
+        for node in self._changes.keys():
+            dbgstr(node + ' has changed: ' + '; '.join(self._changes[node]))
+            if not any([x.startswith('input changed: ')
+                        for x in self._changes[node]]):
+                untrustme.append(node)
         return untrustme
+
+    def listchanges(self):
+        """Lists the nodes invalidated by the last change in the graph
+        and the reasons why."""
+        mystr = ''
+        for node in self._changes.keys():
+            mystr += str(node) + '\t ' + '; '.join(self._changes[node]) + '\n'
+        print(mystr)
     
             
 #    def modSummary(self):
@@ -710,13 +1416,35 @@ class protocol():
     # def _dumpResource(self, res):
     #     self._getResource(res).dump()
         
-    def _newResource(self, resname, resval, t):
+    def _newDumpedResource(self, resname, dumped):
+        # the worker has already dumped the resource: its value will
+        # be loaded from the disk only if needed
+        dbgstr('Resource dumped by worker: ' + resname + ' (' +
+               str(dumped.size) + ' bytes)', 2)
+        self._forgetRemote(resname)
+        self._getResource(resname).clear()
+        self._getResource(resname)._buildtime = dumped.buildtime
+        self._getResource(resname)._timestamp = dumped.timestamp
+        self._getResource(resname)._peakmem = dumped.peakmem
+        self._getResource(resname)._fingerprint = dumped.fingerprint
+        self._getResource(resname)._pending = True
+
+    def _newResource(self, resname, resval, t, peakmem=None):
         dbgstr('Updating resource: ' + resname, 2)
         dbgstr('with contents: ' + str(resval), 3)
-        self._getResource(resname).setValue(resval)
+        self._forgetRemote(resname)
+        if isStream(resval):
+            resval = drainStream(resname, resval,
+                                 self._getResource(resname).getStreamPath())
+        self._getResource(resname).setValue(thaw(resval))
         self._getResource(resname).updateFingerprint()
         self._getResource(resname)._buildtime = t
+        if peakmem != None:
+            self._getResource(resname)._peakmem = peakmem
         self._getResource(resname)._timestamp = time.asctime()
+        self._getResource(resname).setCodec(self._getCodec(resname))
+        self._getResource(resname).setCompression(
+            self._getCompression(resname))
         dbgstr('Dumping resource: ' + resname)
         self._getResource(resname).dump()
         
@@ -764,7 +1492,9 @@ class protocol():
             return self._getResource(resname)
         elif self._isDumped(resname):
             dbgstr('Found on disk: ' + str(resname), 2)
-            self._addResource(resname, self._loadResource(resname))
+            #loaded in place: resources may be shared with other
+            #protocols
+            self._getResource(resname).load()
             dbgstr('Resource content is:\n' + str(self._getResource(resname)), 4)
             return self._resmap[resname]
         else:
@@ -778,65 +1508,74 @@ class protocol():
         nodeparams = list()        
         input_nodes = self._getInNodes(node)
         for item in input_nodes:
-            thisnode_inputs = list()
             neededres = item
             dbgstr('Retreiving resource: ' + neededres)
             this_params = self._provideResource(neededres)
             if type(this_params.getValue())==list:
                 dbgstr('Resource type is: list.', 2)
-                for this_param in this_params.getValue():
-                    thisnode_inputs.append(this_param)
             elif self._isResFile(this_params):
                 dbgstr('Resource type is: file.', 2)
-                thisnode_inputs.append(this_params.getValue())
             else:
                 dbgstr('Resource type is: ' + str(type(this_params.getValue())), 2)
-                thisnode_inputs.append(this_params.getValue())
-            if len(thisnode_inputs)==1:
-                nodeparams.append(thisnode_inputs[0])
-            else:
-                nodeparams.append(thisnode_inputs)
+            nodeparams.append(self._makeParam(this_params.getValue()))
+        self._addShard(node, nodeparams)
         
         dbgstr('Ready to run: ' + node, 2)
         dbgstr('through ' + str(self._getModule(node).getValue()), 2)
         dbgstr('on input:\n\t' + str(nodeparams), 3)
         
-        newres, newresname = self._callMod(node, nodeparams)
+        newres, newresname, t = self._callMod(node, nodeparams)
+        self._newResource(newresname, newres, t)
         dbgstr('Build took ' + str(self._resmap[newresname]._buildtime))
 
         return newres
 
-    def _getNodePar(self, node):
-
+    def _getNodePar(self, node, lazy=False):
+        # if lazy is True, inputs that are only on the disk are not
+        # loaded: the worker running the node will read them instead
         nodeparams = list()        
         input_nodes = self._getInNodes(node)
         for item in input_nodes:
-            thisnode_inputs = list()
             neededres = item
-            this_params = self._getResource(neededres)
+            if lazy and not self._isAvailable(neededres) and \
+                    self._isDumped(neededres):
+                dbgstr('Resource will be read by the worker: ' +
+                       neededres, 2)
+                nodeparams.append(
+                    dumpedinput(self._getResource(neededres).getDumpPath()))
+                continue
+            this_params = self._provideResource(neededres)
             if type(this_params.getValue())==list:
                 dbgstr('Resource type is: list.', 2)
-                for this_param in this_params.getValue():
-                    thisnode_inputs.append(this_param)
             elif self._isResFile(this_params):
                 dbgstr('Resource type is: file.', 2)
-                thisnode_inputs.append(this_params.getValue())
             else:
                 dbgstr('Resource type is: ' + str(type(this_params.getValue())), 2)
-                thisnode_inputs.append(this_params.getValue())
-            if len(thisnode_inputs)==1:
-                nodeparams.append(thisnode_inputs[0])
-            else:
-                nodeparams.append(thisnode_inputs)
+            nodeparams.append(makeParam(this_params.getValue()) if lazy
+                              else self._makeParam(this_params.getValue()))
+        self._addShard(node, nodeparams)
         
         return nodeparams
 
+    def _addShard(self, node, nodeparams):
+        # nodes of a family get their shard as last argument
+        shard = self._getGraph().getAttrib(node, 'shard')
+        if shard != None:
+            nodeparams.append(shard)
+
+    def _makeParam(self, value):
+        if self._zerocopy:
+            return makeFrozenParam(value)
+        return makeParam(value)
+
     def _getModule(self, name):
         return self._modules[name]
         
 
     def _callMod(self, node, nodeparams):
         t = time.time()
+        if self._checkinputs:
+            digests = inputDigests(nodeparams)
 
         if not self._checkIsFunction(self._modules[node].getValue()):
             dbgstr('Node '+node+' is not a function: passing itself.', 2)            
@@ -862,14 +1601,26 @@ class protocol():
             dbgstr('Produced list:\n\t' + str(newres), 3)
 
             
+        elif self._getMapChunk(node) != None:
+            dbgstr('Inputs are mapped.', 2)
+            dbgstr('Running node: ' + node)
+            newres = [self._awaitResult(self._modules[node].getValue()(item))
+                      for item in mapItems(nodeparams)]
+            dbgstr('Done.')
+            dbgstr('Produced list:\n\t' + str(newres), 3)
+
         else:
             dbgstr('Inputs are hashed.', 2)
             for nodeparam in nodeparams:
                 dbgstr('Running node: ' + node)
-                newres = self._modules[node].getValue()(nodeparam)
+                newres = self._awaitResult(
+                    self._modules[node].getValue()(nodeparam))
                 dbgstr('Done.')
                 dbgstr('Produced list:\n\t' + str(newres), 3)
 
+        newres = self._awaitResult(newres)
+        if self._checkinputs:
+            checkInputs(node, nodeparams, digests)
         newresname = self._buildResName(node, None, newres)
         dbgstr('Requesting add resource: ' + node, 2)
         t = time.time() - t
@@ -877,29 +1628,6 @@ class protocol():
             
         return newres, newresname, t
 
-    def _callModPar(self, node, nodeparams, queue):
-           
-        dbgstr('Running node: ' + node)
-        funct = self._modules[node].getValue()
-        if len(nodeparams)==0:
-            dbgstr('No input for: ' + str(node), 2)
-            t = time.time()
-            newres = funct()
-            t = time.time() - t    
-        else:
-            t = time.time()
-            newres = funct(*nodeparams)
-            t = time.time() - t
-
-        dbgstr('Produced list:\n\t' + str(newres), 3)
-
-            
-        #the following is needed to correctly match node
-        #and resource when going parallel
-        queue.put((node, newres, t))
-        #return newres
-
-        
     def _checkIsFunction(self, x):
         #return hasattr(self._modules[node].getValue(), '_call_'):
         return type(lambda y:y)==type(x)
@@ -982,7 +1710,7 @@ class protocol():
         dbgstr('Getting resource ' + str(res) + ' from disk.', 2)
         if self._isDumped(res):
             dbgstr('Resource ' + str(self._resmap[res]) + ' found in: ' + self._resmap[res].getDumpPath() ,2)
-            return pickle.load(open(self._resmap[res].getDumpPath(), 'rb'))
+            return resource(res, self._resmap[res].getDumpPath())
         else:
             dbgstr('Resource ' + str(res) + ' not found on disk! I\'ve been looking for: ' + self._resmap[res].getDumpPath())
 
@@ -1018,13 +1746,7 @@ class protocol():
         return self._getGraph()[node]==[]
         
     def _getOutNodesRecursive(self, node):
-        alloutnodes = list()
-        nodestack = list(self.getoutputs(node))
-        while nodestack!=[]:
-            onode = nodestack.pop()
-            nodestack.extend(self.getoutputs(onode))
-            alloutnodes.append(onode)
-        return alloutnodes
+        return list(self._getGraph().getDescendants(node))
 
     def _getLeaves(self):
         leaves = list()
@@ -1085,6 +1807,115 @@ class protocol():
 
 
         
+    def _getLineages(self):
+        # a digest for each node of its code, its attributes and,
+        # recursively, those of all of its inputs: nodes having the
+        # same lineage in different protocols produce the same result
+        import hashlib
+        lineages = dict()
+
+        # inputs come first in topological order, so their lineages
+        # are ready when a node needs them
+        g = self._getGraph()
+        for node in g.getTopoOrder():
+            attribs = g.getAttribs(node)
+            attribs.pop('id', None)
+            code = self._modules[node].getValue()
+            try:
+                code = inspect.getsource(code)
+            except Exception:
+                try:
+                    code = pickle.dumps(code)
+                except Exception:
+                    code = repr(code)
+            h = hashlib.sha1()
+            h.update(repr((node, sorted(attribs.items()))).encode())
+            h.update(code if type(code) == bytes else code.encode())
+            for innode in self._getInNodes(node):
+                h.update(lineages[innode].encode())
+            lineages[node] = h.hexdigest()
+        return lineages
+
+    def _shareResource(self, resname, res):
+        # res is also used by other protocols
+        if self._resmap[resname] is not res:
+            dbgstr('Sharing resource: ' + resname, 2)
+            self._addResource(resname, res)
+
+    def _merge(self, protocols, folder):
+        # turns this (uninitialized) protocol into the union of the
+        # given ones, so that a single schedule builds all of them.
+        # Resources are the same objects of the merged protocols, nodes
+        # sharing a resource become a single node.
+        from pyleaf.gph import graph
+        first = list(protocols.values())[0]
+        for attr in ['_dodump', '_doevict', '_zerocopy', '_checkinputs',
+                     '_budget', '_maxworkers', '_maxtasks', '_startmethod',
+                     '_queuesize', '_cluster']:
+            setattr(self, attr, getattr(first, attr))
+        self._metafolder = folder
+        self._rootdir = os.getcwd()
+        self._buildlock = threading.RLock()
+        self._doc = ''
+        self._resmap = dict()
+        self._modules = dict()
+        self._executors = dict()
+        self._maps = dict()
+        self._codecs = dict()
+        self._compressions = dict()
+        if None in first._executors:
+            self._executors[None] = first._executors[None]
+        if None in first._codecs:
+            self._codecs[None] = first._codecs[None]
+        if None in first._compressions:
+            self._compressions[None] = first._compressions[None]
+
+        g = graph()
+        g._nodeattribs = dict()
+        g._edgeattribs = dict()
+        units = dict()
+        names = dict()
+        for gname, prot in protocols.items():
+            for node in prot._getNodeNames():
+                res = prot._getResource(node)
+                if not id(res) in units:
+                    unit = node
+                    if unit in self._resmap:
+                        unit = node + '[' + str(gname) + ']'
+                    units[id(res)] = unit
+                    self._addResource(unit, res)
+                    self._modules[unit] = prot._modules[node]
+                    if node in prot._executors:
+                        self._executors[unit] = prot._executors[node]
+                    if node in prot._maps:
+                        self._maps[unit] = prot._maps[node]
+                    if node in prot._codecs:
+                        self._codecs[unit] = prot._codecs[node]
+                    if node in prot._compressions:
+                        self._compressions[unit] = prot._compressions[node]
+                    for attr, value in prot._getGraph().getAttribs(node).items():
+                        g.setAttrib(unit, attr, value)
+                    g[unit] = list()
+                names[(gname, node)] = units[id(res)]
+        for gname, prot in protocols.items():
+            pg = prot._getGraph()
+            for node in pg.keys():
+                for onode in pg[node]:
+                    g.addEdge(names[(gname, node)], names[(gname, onode)],
+                              pg.getEdgeAttrib((node, onode), 'id'))
+        self._graphres = resource('graph', os.path.join(folder, 'graph.grp'))
+        self._graphres.setDump(False)
+        self._graphres.setValue(g)
+        return names
+
+    def _unshareResource(self, resname):
+        # back to a resource of this protocol only
+        path = os.path.join(self._metafolder, resname + '.res')
+        if os.path.abspath(self._resmap[resname].getDumpPath()) != \
+                os.path.abspath(path):
+            dbgstr('Unsharing resource: ' + resname, 2)
+            self._addResource(resname, resource(resname, path))
+
     def _setMetaFolder(self, f):
         self._metafolder = f
 
@@ -1097,7 +1928,27 @@ class protocol():
     _graphres = None
     _metafolder = 'leafmeta'
     _dodump = True
+    _doevict = False
+    _zerocopy = False
+    _queuesize = 16
+    _checkinputs = False
     _modules = dict()
     _modhelp = dict()
     _auto_place_files = False
     _doc = ''
+    _pool = None
+    _threads = None
+    _driver = None
+    _looppool = None
+    _cluster = None
+    _activeloop = None
+    _executors = dict()
+    _maps = dict()
+    _codecs = dict()
+    _compressions = dict()
+    _changes = dict()
+    _executorKinds = ['inline', 'thread', 'process', 'remote']
+    _maxworkers = None
+    _maxtasks = None
+    _startmethod = None
+    _budget = (None, None)
@@ -22,11 +22,293 @@
 
 
 import os
+import sys
+import copy
 from pyleaf import log
 import pickle
 import inspect
 
 
+def _readFull(f, buffer):
+    # compressed streams may fill a buffer in more than one read
+    view = memoryview(buffer)
+    while len(view) > 0:
+        n = f.readinto(view)
+        if not n:
+            raise EOFError('Dump file is truncated.')
+        view = view[n:]
+
+
+class codec():
+    """Writes the value of a resource to its dump file and reads it
+    back. Codecs are registered by name in pyleaf.rrc.codecs and
+    selected per node through the LGL attribute codec or
+    pyleaf.ptl.protocol.setCodec. The "auto" codec chooses one by
+    the type of the value."""
+
+    name = None
+
+    #True if reading needs random access to the file
+    random = False
+
+    def accepts(self, value):
+        return True
+
+    def write(self, value, f):
+        raise NotImplementedError
+
+    def read(self, f):
+        raise NotImplementedError
+
+
+class picklecodec(codec):
+    """Plain pickle, with the highest protocol."""
+
+    name = 'pickle'
+
+    def write(self, value, f):
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+
+    def read(self, f):
+        return pickle.load(f)
+
+
+class pickle5codec(codec):
+    """Pickle protocol 5: large buffers (NumPy arrays, bytes) are
+    written out-of-band, straight from memory to the file, and read
+    back into preallocated memory."""
+
+    name = 'pickle5'
+
+    def write(self, value, f):
+        from pyleaf.sch import _wrapBuffers
+        buffers = list()
+        data = pickle.dumps(_wrapBuffers(value), 5,
+                            buffer_callback=buffers.append)
+        buffers = [buffer.raw() for buffer in buffers]
+        pickle.dump((len(data), [x.nbytes for x in buffers]), f)
+        f.write(data)
+        for buffer in buffers:
+            f.write(buffer)
+
+    def read(self, f):
+        size, sizes = pickle.load(f)
+        data = f.read(size)
+        buffers = list()
+        for size in sizes:
+            buffer = bytearray(size)
+            _readFull(f, buffer)
+            buffers.append(buffer)
+        return pickle.loads(data, buffers=buffers)
+
+
+class npycodec(codec):
+    """NumPy arrays in .npy format."""
+
+    name = 'npy'
+
+    def accepts(self, value):
+        numpy = sys.modules.get('numpy')
+        return numpy != None and type(value) == numpy.ndarray and \
+            not value.dtype.hasobject
+
+    def write(self, value, f):
+        import numpy
+        numpy.save(f, value, allow_pickle=False)
+
+    def read(self, f):
+        import numpy
+        return numpy.load(f, allow_pickle=False)
+
+
+class npzcodec(codec):
+    """Dictionaries of NumPy arrays in .npz format."""
+
+    name = 'npz'
+    random = True
+
+    def accepts(self, value):
+        return type(value) == dict and len(value) > 0 and \
+            all([type(k) == str and npycodec().accepts(v)
+                 for (k, v) in value.items()])
+
+    def write(self, value, f):
+        import numpy
+        numpy.savez(f, **value)
+
+    def read(self, f):
+        import numpy
+        with numpy.load(f, allow_pickle=False) as arrays:
+            return dict([(k, arrays[k]) for k in arrays.files])
+
+
+class rawcodec(codec):
+    """bytes and bytearray objects, written as they are."""
+
+    name = 'raw'
+
+    def accepts(self, value):
+        return type(value) in (bytes, bytearray)
+
+    def write(self, value, f):
+        pickle.dump((type(value).__name__, len(value)), f)
+        f.write(value)
+
+    def read(self, f):
+        kind, size = pickle.load(f)
+        if kind == 'bytes':
+            return f.read(size)
+        value = bytearray(size)
+        _readFull(f, value)
+        return value
+
+
+codecs = dict()
+
+#codecs tried by "auto", in order; the last one accepts any value
+autocodecs = ['npy', 'npz', 'raw', 'pickle5']
+
+
+def registerCodec(newcodec):
+    codecs[newcodec.name] = newcodec
+
+
+def getCodec(name, value=None):
+    # resolves "auto" by the type of value
+    if name == 'auto':
+        for name in autocodecs:
+            if codecs[name].accepts(value):
+                break
+    if not name in codecs:
+        raise NameError('Unknown codec: ' + str(name) + '. Use one of: ' +
+                        ', '.join(['auto'] + sorted(codecs.keys())))
+    return codecs[name]
+
+
+for newcodec in [picklecodec(), pickle5codec(), npycodec(), npzcodec(),
+                 rawcodec()]:
+    registerCodec(newcodec)
+
+
+#compression levels of the stdlib compressors
+compresslevels = {'zlib': 6, 'bz2': 9, 'lzma': 6}
+
+#"auto" compresses (with zlib) values whose first probesize bytes
+#shrink at least to this fraction of their size
+autoratio = 0.9
+probesize = 1024 * 1024
+
+
+def checkCompression(method):
+    # None, 'auto' or one of the compresslevels keys
+    if method != None and method != 'auto' and not method in compresslevels:
+        raise NameError('Unknown compression: ' + str(method) +
+                        '. Use one of: auto, ' +
+                        ', '.join(sorted(compresslevels.keys())) + '.')
+
+
+def openCompressed(method, f, mode):
+    # streaming (de)compressor over the open file f
+    if method == 'zlib':
+        import gzip
+        return gzip.GzipFile(fileobj=f, mode=mode,
+                             compresslevel=compresslevels['zlib'])
+    if method == 'bz2':
+        import bz2
+        return bz2.BZ2File(f, mode, compresslevel=compresslevels['bz2'])
+    if method == 'lzma':
+        import lzma
+        if mode.startswith('w'):
+            return lzma.LZMAFile(f, mode, preset=compresslevels['lzma'])
+        return lzma.LZMAFile(f, mode)
+    raise NameError('Unknown compression: ' + str(method) + '.')
+
+
+class _writeonly():
+    # hides seek and tell, so that writers (like zipfile) do not try
+    # to go back in a compressed stream
+    def __init__(self, f):
+        self._file = f
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def read(self, size=-1):
+        #only checked for, by numpy, to recognize a file object
+        import io
+        raise io.UnsupportedOperation('read')
+
+    def flush(self):
+        pass
+
+
+class payloadwriter():
+    """File-like object through which the value of a resource is
+    written after its header, compressed by the given method, if
+    any. The method actually used is written first. With "auto", the
+    first probesize bytes are kept and compressed as a sample to
+    decide whether compressing the value is worth it."""
+
+    def __init__(self, f, method):
+        self._file = f
+        self._stream = None
+        self._sample = list()
+        self._size = 0
+        self.method = method
+        if method != 'auto':
+            self._start(method)
+
+    def _start(self, method):
+        self.method = method
+        pickle.dump(method, self._file)
+        if method == None:
+            self._stream = self._file
+        else:
+            self._stream = openCompressed(method, self._file, 'wb')
+
+    def _decide(self):
+        import zlib
+        sample = b''.join(self._sample)
+        self._sample = None
+        ratio = len(zlib.compress(sample, 1)) / float(max(len(sample), 1))
+        log.send('Compression ratio of sample is: ' + '%.2f' % ratio, 2)
+        self._start('zlib' if ratio <= autoratio else None)
+        self._stream.write(sample)
+
+    def write(self, data):
+        if self._stream != None:
+            return self._stream.write(data)
+        view = memoryview(data).cast('B')
+        needed = probesize - self._size
+        self._sample.append(bytes(view[:needed]))
+        self._size += min(needed, len(view))
+        if self._size >= probesize:
+            self._decide()
+            if len(view) > needed:
+                self._stream.write(view[needed:])
+        return len(view)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._stream == None:
+            self._decide()
+        if self._stream is not self._file:
+            self._stream.close()
+
+
+def openPayload(f, method, random=False):
+    # stream from which the value of a resource is read
+    if method == None:
+        return f
+    stream = openCompressed(method, f, 'rb')
+    if random:
+        import io
+        return io.BytesIO(stream.read())
+    return stream
+
+
 class resource():
         
     def __init__(self, name, path):
@@ -34,11 +316,12 @@ class resource():
         self._name=name
         self._path = path
         if self.isDumped():
-            self.load()
+            self.loadHeader()
             
     def clear(self):
         self._contents = None
         self._fingerprint = None
+        self._pending = False
 
             
     def name(self):
@@ -58,18 +341,51 @@ class resource():
     def clearDump(self):
         if self.isDumped():
             os.remove(self._path)
+        if os.path.exists(self.getStreamPath()):
+            os.remove(self.getStreamPath())
             
+    def _read(self, value=True):
+        # the resource stored in the dump file, with its value only if
+        # requested: the value follows the resource, written by its
+        # codec, unless the file was dumped by an older version
+        with open(self._path, 'rb') as f:
+            res = pickle.load(f)
+            if value and res._format != None:
+                valuecodec = getCodec(res._format)
+                if res._compression != None:
+                    f = openPayload(f, pickle.load(f), valuecodec.random)
+                res._contents = valuecodec.read(f)
+        if value and res._fingerprint is resource:
+            res._fingerprint = res._contents
+        return res
+
+    def _setHeader(self, res):
+        ## Now it should be a "self = res" but I currently don't
+        ## trust that.
+        self._timestamp = res._timestamp
+        self._buildtime = res._buildtime
+        self._peakmem = res._peakmem
+        self._fingerprint = res._fingerprint
+        self.setIsFile(res.isFile())
+
+    def loadHeader(self):
+        """Reads everything but the value, which is read when first
+        needed."""
+        log.send(self.name() + ' is dumped in ' + self._path + ': reading header.', 3)
+        res = self._read(False)
+        if res._format == None:
+            self._setHeader(res)
+            self.setValue(res.getValue())
+            return
+        self._setHeader(res)
+        self._contents = None
+        self._pending = True
+
     def load(self):
         if self.isDumped():
             log.send(self.name() + ' is dumped in ' + self._path + ': loading it.')
-            res = pickle.load(open(self._path, 'rb'))
-            ## Now it should be a "self = res" but I currently don't
-            ## trust that.
-            self._timestamp = res._timestamp
-            self._buildtime = res._buildtime
-            self._fingerprint = res._fingerprint
-            self.setDumpPath(res.getDumpPath())
-            self.setIsFile(res.isFile())
+            res = self._read()
+            self._setHeader(res)
             self.setValue(res.getValue())
         else:
             log.send(self.name() + ' is not dumped.', 2)
@@ -93,16 +409,44 @@ class resource():
         log.send('fingerprint: ' + str(self._fingerprint), 3)
 
         log.send('Dumping to file: ' + self._path, 2)
-        pickle.dump(self, open(self._path, 'wb'))
+        #writing to a temporary file first, so that a dump file is
+        #never seen half written
+        valuecodec = getCodec(self._codec, self._contents)
+        log.send('Codec is: ' + valuecodec.name, 3)
+        header = copy.copy(self)
+        header._contents = None
+        header._pending = False
+        header._format = valuecodec.name
+        if self._fingerprint is self._contents:
+            #not written twice
+            header._fingerprint = resource
+        tmppath = self._path + '.tmp' + str(os.getpid())
+        try:
+            with open(tmppath, 'wb') as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                if self._compression == None:
+                    valuecodec.write(self._contents, f)
+                else:
+                    stream = payloadwriter(f, self._compression)
+                    valuecodec.write(self._contents, _writeonly(stream))
+                    stream.close()
+                    log.send('Compression is: ' + str(stream.method), 2)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+        os.replace(tmppath, self._path)
         
     def isAvailable(self):
-        return self._contents != None
+        return self._contents is not None
         
     def setValue(self, v):
         log.send('New value is: ' + str(v), 3)
         self._contents = v
+        self._pending = False
         
     def getValue(self):
+        if self._pending:
+            self.load()
         return self._contents
         
     def setIsFile(self, isit = True):
@@ -118,10 +462,14 @@ class resource():
         
     def getDumpPath(self):
         return self._path
+
+    def getStreamPath(self):
+        # file holding the chunks of a stream resource
+        return os.path.splitext(self._path)[0] + '.stream'
         
     def changed(self):
 
-        return self._fingerprint != self._makeFingerprint(self._contents)
+        return self.getFingerprint() != self._makeFingerprint(self._contents)
         
     def _makeFingerprint(self, obj):
         try:
@@ -134,6 +482,9 @@ class resource():
             return obj
             
     def getFingerprint(self):
+        if self._fingerprint is resource:
+            #same as the value stored in the dump file
+            self._fingerprint = self._read().getValue()
         return self._fingerprint
     
     def updateFingerprint(self):
@@ -147,6 +498,20 @@ class resource():
     def setDump(self, d):
         self._dodump = d
 
+    def setCodec(self, name):
+        getCodec(name)
+        self._codec = name
+
+    def getCodec(self):
+        return self._codec
+
+    def setCompression(self, method):
+        checkCompression(method)
+        self._compression = method
+
+    def getCompression(self):
+        return self._compression
+
     _name = ''    
     _contents = None
     _dodump = True
@@ -155,3 +520,8 @@ class resource():
     _isfile = False
     _timestamp = None
     _buildtime = None
+    _peakmem = None
+    _codec = 'auto'
+    _pending = False
+    _compression = None
+    _format = None
@@ -0,0 +1,980 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2012-2013 Francesco Napolitano, franapoli@gmail.com
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import sys
+import time
+import pickle
+import heapq
+import hashlib
+import inspect
+import io
+import weakref
+from collections.abc import Sequence
+from types import MappingProxyType
+from pyleaf.log import send as dbgstr
+
+#buffers of at least this size are sent back from worker processes
+#through a memory-mapped file instead of the result pipe
+minsharedsize = 1024 * 1024
+
+#chunks a streaming node can produce ahead of its slowest consumer
+queuesize = 16
+
+
+class scheduler():
+    """Leaf Scheduler
+
+    Keeps track of the nodes that must be built during a call to
+    protocol.provide. For each of them the scheduler counts how many
+    of its inputs are still missing: a node enters the ready queue as
+    soon as the counter drops to zero. Marking a node as done only
+    touches its output nodes, so that no rescan of the pending nodes
+    is ever needed.
+
+    If the expected build time of nodes is given through costs, ready
+    nodes are returned longest remaining path first, i.e. the ones
+    heading the longest chains of work downstream start first.
+
+    """
+
+    def __init__(self, graph, nodes, costs=None):
+        self._ready = list()
+        self._running = set()
+        self._done = set()
+        self._missing = dict()
+        self._outnodes = dict()
+        self._order = dict()
+
+        todo = set(nodes)
+        for node in todo:
+            self._missing[node] = 0
+        for node in todo:
+            self._outnodes[node] = [x for x in graph.getOutNodes(node)
+                                    if x in todo]
+            for onode in self._outnodes[node]:
+                self._missing[onode] += 1
+
+        self._priority = self._pathLengths(nodes, costs)
+        for node in nodes:
+            if self._missing[node] == 0:
+                self._push(node)
+
+    def _pathLengths(self, nodes, costs):
+        # length of the longest path from each node to the end of the
+        # build, computed in reverse topological order
+        if costs == None:
+            return dict.fromkeys(nodes, 0)
+        missing = dict(self._missing)
+        order = [node for node in nodes if missing[node] == 0]
+        for node in order:
+            for onode in self._outnodes[node]:
+                missing[onode] -= 1
+                if missing[onode] == 0:
+                    order.append(onode)
+        lengths = dict()
+        for node in reversed(order):
+            lengths[node] = costs[node] + max(
+                [lengths[x] for x in self._outnodes[node]] + [0])
+        return lengths
+
+    def _push(self, node):
+        self._order[node] = len(self._order)
+        heapq.heappush(self._ready, (-self._priority[node],
+                                     self._order[node], node))
+
+    def getPriority(self, node):
+        return self._priority[node]
+
+    def hasReady(self):
+        return len(self._ready) > 0
+
+    def countReady(self):
+        return len(self._ready)
+
+    def countRunning(self):
+        return len(self._running)
+
+    def finished(self):
+        return len(self._ready) == 0 and len(self._running) == 0
+
+    def nextReady(self, canrun=None):
+        # returns the ready node with the highest priority among those
+        # accepted by canrun, or None
+        skipped = list()
+        found = None
+        while len(self._ready) > 0:
+            item = heapq.heappop(self._ready)
+            if canrun == None or canrun(item[2]):
+                found = item[2]
+                self._running.add(found)
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(self._ready, item)
+        return found
+
+    def isPending(self, node):
+        # part of the build and not started yet
+        return (node in self._missing and not node in self._running and
+                not node in self._done)
+
+    def isDone(self, node):
+        # done, or not part of the build at all
+        return not node in self._missing or node in self._done
+
+    def claim(self, node):
+        # starts a node before all of its inputs are done, as the
+        # consumers of a stream do
+        self._ready = [x for x in self._ready if x[2] != node]
+        heapq.heapify(self._ready)
+        self._running.add(node)
+
+    def setFailed(self, node):
+        # nodes depending on a failed node never become ready
+        self._running.discard(node)
+
+    def unfinished(self):
+        return [x for x in self._missing if not x in self._done]
+
+    def setDone(self, node):
+        self._running.discard(node)
+        self._done.add(node)
+        for onode in self._outnodes[node]:
+            self._missing[onode] -= 1
+            if self._missing[onode] == 0 and self.isPending(onode):
+                self._push(onode)
+
+
+class refcounter():
+    """Counts, for each resource, the nodes of the current build that
+    still have to read it."""
+
+    def __init__(self, graph, nodes):
+        self._readers = dict()
+        self._inputs = dict()
+        todo = set(nodes)
+        for node in graph.keys():
+            for onode in graph.getOutNodes(node):
+                if onode in todo:
+                    self._readers[node] = self._readers.get(node, 0) + 1
+                    self._inputs.setdefault(onode, list()).append(node)
+
+    def release(self, node):
+        # the inputs of node have been read: returns the resources
+        # that no other node is going to read
+        unused = list()
+        for innode in self._inputs.pop(node, []):
+            self._readers[innode] -= 1
+            if self._readers[innode] == 0:
+                unused.append(innode)
+        return unused
+
+    def isUnused(self, node):
+        return self._readers.get(node, 0) == 0
+
+
+def _initWorker(modnames):
+    # user modules are imported once, when the worker starts, rather
+    # than at the first node that needs them
+    for modname in modnames:
+        __import__(modname)
+
+
+def runTask(node, funct, nodeparams, check=False):
+    dbgstr('Running node: ' + node)
+    if check:
+        digests = inputDigests(nodeparams)
+    t = time.time()
+    if len(nodeparams) == 0:
+        dbgstr('No input for: ' + str(node), 2)
+        newres = funct()
+    else:
+        newres = funct(*nodeparams)
+    t = time.time() - t
+    if check:
+        checkInputs(node, nodeparams, digests)
+    dbgstr('Produced list:\n\t' + str(newres), 3)
+    return newres, t
+
+
+async def runCoroutine(node, funct, nodeparams):
+    dbgstr('Running node: ' + node)
+    t = time.time()
+    newres = await funct(*nodeparams)
+    t = time.time() - t
+    dbgstr('Produced list:\n\t' + str(newres), 3)
+    return newres, t
+
+
+def mapItems(nodeparams):
+    # items a node in map mode is applied to: the elements of list
+    # inputs and any other input as a whole
+    items = list()
+    for param in nodeparams:
+        if type(param) == list or isinstance(param, readonlylist):
+            items.extend(param)
+        else:
+            items.append(param)
+    return items
+
+
+def splitChunks(items, chunksize):
+    chunksize = max(1, int(chunksize or 1))
+    return [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+
+
+def runChunk(node, funct, chunk):
+    dbgstr('Running node: ' + node + ' on ' + str(len(chunk)) + ' items.', 2)
+    return [funct(item) for item in chunk]
+
+
+async def runMapCoroutine(node, funct, items):
+    import asyncio
+    dbgstr('Running node: ' + node + ' on ' + str(len(items)) + ' items.')
+    t = time.time()
+    newres = list(await asyncio.gather(*[funct(item) for item in items]))
+    t = time.time() - t
+    dbgstr('Produced list:\n\t' + str(newres), 3)
+    return newres, t
+
+
+def gatherChunks(node, chunktasks):
+    # returns a Future for the (results, buildtime) of a node in map
+    # mode, with the chunk results concatenated in order
+    from concurrent.futures import Future
+    task = Future()
+    results = [None] * len(chunktasks)
+    remaining = [len(chunktasks)]
+    t = time.time()
+
+    def chunkdone(i, chunktask):
+        if task.done():
+            return
+        if chunktask.exception() != None:
+            task.set_exception(chunktask.exception())
+            return
+        results[i] = chunktask.result()
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            newres = [x for chunk in results for x in chunk]
+            dbgstr('Gathered ' + str(len(newres)) + ' results for: ' + node, 2)
+            task.set_result((newres, time.time() - t))
+
+    if len(chunktasks) == 0:
+        task.set_result((list(), 0.0))
+    for i, chunktask in enumerate(chunktasks):
+        chunktask.add_done_callback(
+            lambda chunktask, i=i: chunkdone(i, chunktask))
+    return task
+
+
+def _restoreBuffer(kind, buffer):
+    return kind(buffer)
+
+
+class _rawbuffer():
+    # lets large bytes and bytearray objects travel out-of-band, as
+    # pickle always copies them in-band
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __reduce_ex__(self, protocol):
+        return _restoreBuffer, (type(self._obj),
+                                pickle.PickleBuffer(self._obj))
+
+
+def _wrapBuffers(obj, nested=False):
+    # looks for raw buffers in the result and, one level down, in the
+    # items of tuples, lists and dicts
+    if type(obj) in (bytes, bytearray) and len(obj) >= minsharedsize:
+        return _rawbuffer(obj)
+    if nested:
+        return obj
+    if type(obj) in (tuple, list):
+        return type(obj)([_wrapBuffers(x, True) for x in obj])
+    if type(obj) == dict:
+        return dict([(k, _wrapBuffers(v, True)) for (k, v) in obj.items()])
+    return obj
+
+
+class sharedresult():
+    """Result of a node run in a worker process.
+
+    The result is pickled with protocol 5: its large buffers (NumPy
+    arrays, bytes and any other object supporting out-of-band
+    buffers) are written to a memory-mapped file, in /dev/shm when
+    available, and only the remaining pickle stream goes through the
+    pipe. When loaded in the protocol process, arrays are rebuilt as
+    zero-copy, copy-on-write views of the mapped file (bytes and
+    bytearray objects are copied out of it once).
+
+    """
+
+    def __init__(self, newres):
+        buffers = list()
+        self._data = pickle.dumps(_wrapBuffers(newres), 5,
+                                  buffer_callback=buffers.append)
+        self.peakmem = None
+        self._path = None
+        self._sizes = [buffer.raw().nbytes for buffer in buffers]
+
+        if sum(self._sizes) < minsharedsize:
+            self._buffers = [buffer.raw().tobytes() for buffer in buffers]
+            return
+
+        import tempfile
+        shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, self._path = tempfile.mkstemp(prefix='pyleaf-', dir=shmdir)
+        with os.fdopen(fd, 'wb') as f:
+            for buffer in buffers:
+                f.write(buffer.raw())
+        self._buffers = None
+
+    def discard(self):
+        # removes the mapped file of a result that won't be loaded
+        if self._path != None and os.path.exists(self._path):
+            os.remove(self._path)
+
+    def load(self):
+        if self._path == None:
+            return pickle.loads(self._data, buffers=self._buffers)
+
+        import mmap
+        with open(self._path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        #the mapping stays valid after the file is removed, and it is
+        #released when the last view on it is garbage collected
+        os.remove(self._path)
+        view = memoryview(mapped)
+        buffers = list()
+        offset = 0
+        for size in self._sizes:
+            buffers.append(view[offset:offset + size])
+            offset += size
+        return pickle.loads(self._data, buffers=buffers)
+
+
+def streams(funct):
+    """Decorator declaring that a node function consumes streams: an
+    input coming from a streaming node is passed as an iterator over
+    its chunks, while they are produced, instead of as a whole
+    list. The same can be declared through the LGL node attribute
+    stream=true."""
+    funct.leaf_streams = True
+    return funct
+
+
+def isStream(value):
+    # generators and other iterators returned by nodes are streams of
+    # chunks (open files excluded)
+    if inspect.isgenerator(value):
+        return True
+    return (hasattr(type(value), '__next__') and
+            hasattr(type(value), '__iter__') and
+            not isinstance(value, io.IOBase))
+
+
+class stream():
+    """Result of a streaming node: the chunks it produced, stored one
+    after the other in a file and read back lazily, one at a time,
+    when iterated."""
+
+    def __init__(self, path, count, digest):
+        self._path = path
+        self._count = count
+        self._digest = digest
+
+    def getPath(self):
+        return self._path
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        with open(self._path, 'rb') as f:
+            for i in range(self._count):
+                yield pickle.load(f)
+
+    def __eq__(self, other):
+        return (isinstance(other, stream) and self._path == other._path
+                and self._digest == other._digest)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return ('stream(' + self._path + ', ' + str(self._count) +
+                ' chunks)')
+
+
+class streamwriter():
+    # persists chunks as they come; the stream file appears only when
+    # complete
+    def __init__(self, path):
+        self._path = path
+        self._tmppath = path + '.tmp' + str(os.getpid())
+        self._file = open(self._tmppath, 'wb')
+        self._count = 0
+        self._digest = hashlib.sha1()
+
+    def write(self, chunk):
+        data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+        self._digest.update(data)
+        self._file.write(data)
+        self._count += 1
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmppath, self._path)
+        return stream(self._path, self._count, self._digest.hexdigest())
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmppath)
+
+
+def drainStream(node, value, path):
+    dbgstr('Storing stream of: ' + node, 2)
+    writer = streamwriter(path)
+    try:
+        for chunk in value:
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+class chunkqueue():
+    # bounded queue from a streaming node to one of its consumers: the
+    # producer blocks when the consumer falls maxsize chunks behind
+    _end = object()
+
+    def __init__(self, maxsize, failed):
+        import queue
+        self._queue = queue.Queue(maxsize)
+        self._failed = failed
+        self._detached = False
+
+    def put(self, chunk):
+        import queue
+        while not self._detached:
+            if self._failed.is_set():
+                raise NameError('Stream aborted.')
+            try:
+                self._queue.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.put(self._end)
+
+    def detach(self):
+        # the consumer has returned: further chunks are dropped
+        self._detached = True
+
+    def __iter__(self):
+        import queue
+        while True:
+            try:
+                chunk = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._failed.is_set():
+                    raise NameError('Stream aborted.')
+                continue
+            if chunk is self._end:
+                return
+            yield chunk
+
+
+class pipeline():
+    """Runs a streaming node together with the nodes consuming its
+    stream, each one in a thread of its own. Chunks are passed through
+    bounded queues as soon as they are produced, and persisted one by
+    one. Consumers that stream in turn can feed further consumers.
+
+    """
+
+    def __init__(self, maxsize=queuesize):
+        import threading
+        self._maxsize = maxsize
+        self._failed = threading.Event()
+        self._members = list()
+        self._outputs = dict()
+        self._inputs = dict()
+        self._results = dict()
+        self._errors = dict()
+
+    def connect(self, node):
+        # returns an iterator over the chunks of node, to be passed to
+        # one of its consumers
+        q = chunkqueue(self._maxsize, self._failed)
+        self._outputs.setdefault(node, list()).append(q)
+        return q
+
+    def add(self, node, funct, nodeparams, path):
+        self._members.append((node, funct, nodeparams, path))
+        self._inputs[node] = [x for x in nodeparams
+                              if isinstance(x, chunkqueue)]
+
+    def _runMember(self, node, funct, nodeparams, path):
+        outputs = self._outputs.get(node, list())
+        try:
+            dbgstr('Running node: ' + node)
+            t = time.time()
+            newres = funct(*nodeparams)
+            if isStream(newres):
+                writer = streamwriter(path)
+                try:
+                    for chunk in newres:
+                        writer.write(chunk)
+                        for q in outputs:
+                            q.put(chunk)
+                except BaseException:
+                    writer.abort()
+                    raise
+                newres = writer.close()
+            elif len(outputs) > 0:
+                for chunk in newres if type(newres) == list else [newres]:
+                    for q in outputs:
+                        q.put(chunk)
+            for q in outputs:
+                q.close()
+            self._results[node] = (newres, time.time() - t)
+            dbgstr('Done: ' + node)
+        except BaseException as e:
+            self._errors[node] = e
+            self._failed.set()
+        finally:
+            for q in self._inputs[node]:
+                q.detach()
+
+    def run(self):
+        # returns a dictionary from node names to (result, buildtime)
+        # for the nodes that completed and one from node names to
+        # exceptions for the others
+        import threading
+        threads = [threading.Thread(target=self._runMember, args=member,
+                                    daemon=True)
+                   for member in self._members]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self._results, self._errors
+
+    def start(self):
+        # runs the pipeline in the background, returns a Future
+        import threading
+        from concurrent.futures import Future
+        task = Future()
+
+        def target():
+            try:
+                task.set_result(self.run())
+            except BaseException as e:
+                task.set_exception(e)
+        threading.Thread(target=target, daemon=True).start()
+        return task
+
+
+def makeParam(value):
+    # list resources are passed as a copy, single element lists as
+    # their only element. Streams are passed as lists of chunks.
+    if isinstance(value, stream):
+        value = list(value)
+    if type(value) == list:
+        if len(value) == 1:
+            return value[0]
+        return list(value)
+    return value
+
+
+class readonlylist(Sequence):
+    """Read-only view of a list resource, passed to nodes instead of
+    a copy of the list."""
+
+    def __init__(self, items):
+        self._items = items
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __eq__(self, other):
+        if isinstance(other, readonlylist):
+            other = other._items
+        return list(self._items) == list(other) \
+            if isinstance(other, (list, tuple)) else False
+
+    def __repr__(self):
+        return 'readonlylist(' + repr(self._items) + ')'
+
+    def __reduce__(self):
+        return list, (self._items,)
+
+
+def freeze(value):
+    # returns a read-only view of value without copying it. Only
+    # lists, dicts and NumPy arrays are protected.
+    numpy = sys.modules.get('numpy')
+    if numpy != None and isinstance(value, numpy.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+        return value
+    if type(value) == list:
+        return readonlylist(value)
+    if type(value) == dict:
+        return MappingProxyType(value)
+    return value
+
+
+def thaw(value):
+    # nodes returning their own inputs give back a view: the
+    # underlying value is stored instead
+    if isinstance(value, readonlylist):
+        return value._items
+    if isinstance(value, MappingProxyType):
+        return dict(value)
+    return value
+
+
+def makeFrozenParam(value):
+    # like makeParam, without copying lists
+    if isinstance(value, stream):
+        value = list(value)
+    if type(value) == list and len(value) == 1:
+        return freeze(value[0])
+    return freeze(value)
+
+
+def _digest(value):
+    if isinstance(value, readonlylist):
+        value = value._items
+    elif isinstance(value, MappingProxyType):
+        value = dict(value)
+    try:
+        return hashlib.sha1(pickle.dumps(value, 5)).digest()
+    except Exception:
+        return None
+
+
+def inputDigests(nodeparams):
+    return [_digest(x) for x in nodeparams]
+
+
+def checkInputs(node, nodeparams, digests):
+    # debugging aid: raises an error if the node has modified its inputs
+    for i, value in enumerate(nodeparams):
+        if digests[i] != None and _digest(value) != digests[i]:
+            raise NameError('Node ' + node + ' has modified its input ' +
+                            'number ' + str(i + 1) + '. Inputs are ' +
+                            'shared with other nodes and must not be ' +
+                            'changed.')
+
+
+class dumpedinput():
+    """Input of a node that the worker reads from its dump file."""
+
+    def __init__(self, path):
+        self._path = path
+
+    def load(self):
+        from pyleaf.rrc import resource
+        return makeParam(resource('input', self._path).getValue())
+
+
+class dumpedresult():
+    """Result of a node that was dumped by the worker itself. Only
+    the information needed to update the protocol is sent back."""
+
+    def __init__(self, path, buildtime, timestamp, fingerprint=None):
+        self.path = path
+        self.buildtime = buildtime
+        self.timestamp = timestamp
+        self.fingerprint = fingerprint
+        self.size = os.path.getsize(path)
+        self.peakmem = None
+
+
+def parseSize(size):
+    # sizes can be given as numbers of bytes or as strings like "512M"
+    if size == None or type(size) in (int, float):
+        return size
+    size = str(size).strip().upper().rstrip('B')
+    units = 'KMGT'
+    if len(size) > 0 and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(float(size))
+
+
+def requires(cpus=None, mem=None):
+    """Decorator declaring the resources needed by a node function:
+    the number of CPU slots it occupies and its peak memory (in bytes
+    or as a string like "4G"). The same can be declared through the
+    LGL node attributes cpus and mem."""
+    def declare(funct):
+        funct.leaf_requires = dict(cpus=cpus, mem=parseSize(mem))
+        return funct
+    return declare
+
+
+def _resetPeakMemory():
+    # on Linux, the peak resident size of a process can be reset
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except Exception:
+        pass
+
+
+def _getPeakMemory():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    try:
+        import resource as rusage
+        return rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return None
+
+
+def runSharedTask(node, funct, nodeparams, path=None, codec='auto',
+                  compression=None, streampath=None):
+    _resetPeakMemory()
+    nodeparams = [x.load() if isinstance(x, dumpedinput) else x
+                  for x in nodeparams]
+    newres, t = runTask(node, funct, nodeparams)
+    if isStream(newres):
+        # generators can't be sent back: their chunks are stored here
+        # and only the stream is returned
+        newres = drainStream(node, newres, streampath)
+    if path == None:
+        result = sharedresult(newres)
+        result.peakmem = _getPeakMemory()
+        return result, t
+
+    from pyleaf.rrc import resource
+    dbgstr('Dumping resource: ' + node)
+    res = resource(node, path)
+    res.setCodec(codec)
+    res.setCompression(compression)
+    res.setValue(newres)
+    res.updateFingerprint()
+    res._buildtime = t
+    res._timestamp = time.asctime()
+    res._peakmem = _getPeakMemory()
+    res.dump()
+    fingerprint = res._fingerprint
+    if fingerprint is res._contents:
+        # the value itself: read back from the dump file when needed
+        fingerprint = resource
+    result = dumpedresult(path, t, res._timestamp, fingerprint)
+    result.peakmem = res._peakmem
+    return result, t
+
+
+def discardResult(task):
+    # done callback of tasks whose results will never be loaded
+    if task.cancelled() or task.exception() != None:
+        return
+    newres = task.result()
+    if type(newres) == tuple:
+        newres = newres[0]
+    if isinstance(newres, sharedresult):
+        newres.discard()
+
+
+def unpackResult(newres):
+    if isinstance(newres, sharedresult):
+        return newres.load()
+    return newres
+
+
+class workerpool():
+    """Persistent pool of worker processes.
+
+    The pool is created the first time a protocol runs in parallel
+    and is then reused by all of its subsequent builds, so that
+    workers are not forked again for every node. At most maxworkers
+    nodes are run at the same time. If maxtasks is given, each worker
+    is replaced by a fresh one after running that many nodes.
+
+    Workers are started with the multiprocessing start method given
+    by method. Replacing a worker forks the calling process while the
+    pool is in use: with the 'fork' method the new worker would
+    inherit the locks held by other threads at that time, so workers
+    are not replaced if threaded is true.
+
+    """
+
+    def __init__(self, maxworkers=None, maxtasks=None, modnames=(),
+                 method=None, threaded=False):
+        import multiprocessing
+
+        if maxworkers == None:
+            maxworkers = os.cpu_count() or 1
+        self._maxworkers = maxworkers
+        self._maxtasks = maxtasks
+        context = multiprocessing.get_context(method)
+        self._method = context.get_start_method()
+        self._recycles = maxtasks != None and not self._unsafe(threaded)
+        if maxtasks != None and not self._recycles:
+            dbgstr('Workers are not replaced: forking is not safe while ' +
+                   'other threads are running.', 2)
+
+        dbgstr('Starting a pool of ' + str(maxworkers) + ' workers.', 2)
+        self._pool = context.Pool(maxworkers, _initWorker,
+                                  (tuple(modnames),),
+                                  maxtasks if self._recycles else None)
+        # a pool that is never shut down is terminated when collected
+        # or at exit, before multiprocessing tears down its pipes
+        self._finalizer = weakref.finalize(self, self._pool.terminate)
+
+    def size(self):
+        return self._maxworkers
+
+    def _unsafe(self, threaded):
+        return threaded and self._method == 'fork'
+
+    def matches(self, maxworkers, maxtasks, threaded=False):
+        return ((maxworkers == None or maxworkers == self._maxworkers) and
+                maxtasks == self._maxtasks and
+                not (self._recycles and self._unsafe(threaded)))
+
+    def submit(self, node, funct, nodeparams, path=None, codec='auto',
+               compression=None, streampath=None):
+        # results are delivered through a concurrent.futures.Future, so
+        # that callers can wait on any subset of the running tasks. If
+        # path is given, the worker dumps the result there, through
+        # the given codec and compression. Streams are stored by the
+        # worker in streampath.
+        from concurrent.futures import Future
+        task = Future()
+        self._pool.apply_async(runSharedTask,
+                               (node, funct, nodeparams, path, codec,
+                                compression, streampath),
+                               callback=task.set_result,
+                               error_callback=task.set_exception)
+        return task
+
+    def map(self, node, funct, items, chunksize=1):
+        # scatters the items over the workers in chunks of chunksize
+        from concurrent.futures import Future
+        chunktasks = list()
+        for chunk in splitChunks(items, chunksize):
+            chunktask = Future()
+            self._pool.apply_async(runChunk, (node, funct, chunk),
+                                   callback=chunktask.set_result,
+                                   error_callback=chunktask.set_exception)
+            chunktasks.append(chunktask)
+        return gatherChunks(node, chunktasks)
+
+    def shutdown(self):
+        dbgstr('Shutting down worker pool.', 2)
+        self._finalizer.detach()
+        self._pool.close()
+        self._pool.join()
+
+
+class threadpool():
+    """Pool of threads shared by the nodes of a protocol that don't
+    need a process of their own (I/O bound nodes or nodes releasing
+    the GIL). Nodes run in the same process of the protocol, so their
+    inputs are passed by reference.
+
+    """
+
+    def __init__(self, maxworkers=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        if maxworkers == None:
+            maxworkers = os.cpu_count() or 1
+        self._maxworkers = maxworkers
+        dbgstr('Starting a pool of ' + str(maxworkers) + ' threads.', 2)
+        self._executor = ThreadPoolExecutor(maxworkers)
+
+    def size(self):
+        return self._maxworkers
+
+    def matches(self, maxworkers):
+        return maxworkers == None or maxworkers == self._maxworkers
+
+    def submit(self, node, funct, nodeparams, check=False):
+        return self._executor.submit(runTask, node, funct, nodeparams,
+                                     check)
+
+    def map(self, node, funct, items, chunksize=1):
+        return gatherChunks(node, [self._executor.submit(runChunk, node,
+                                                         funct, chunk)
+                                   for chunk in splitChunks(items, chunksize)])
+
+    def shutdown(self):
+        dbgstr('Shutting down thread pool.', 2)
+        self._executor.shutdown()
+
+
+class looppool():
+    """Runs "async def" nodes as coroutines on an event loop.
+
+    If no loop is given, a private one is started in a background
+    thread. Any number of coroutines can be running at the same time.
+
+    """
+
+    def __init__(self, loop=None):
+        import asyncio
+        if loop == None:
+            import threading
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+        self._loop = loop
+
+    def run(self, coro):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def submit(self, node, funct, nodeparams):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(
+            runCoroutine(node, funct, nodeparams), self._loop)
+
+    def map(self, node, funct, items, chunksize=1):
+        # all the items are awaited concurrently: chunksize is ignored
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(
+            runMapCoroutine(node, funct, items), self._loop)
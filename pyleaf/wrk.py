@@ -0,0 +1,352 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2012-2013 Francesco Napolitano, franapoli@gmail.com
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+import os
+import sys
+import socket
+import threading
+import traceback
+import weakref
+from collections import deque
+from pyleaf.log import send as dbgstr
+from pyleaf.sch import runTask, runChunk, makeParam, gatherChunks
+
+#variable holding the key used to authenticate workers when none is
+#given
+keyvar = 'PYLEAF_AUTHKEY'
+
+
+class heldinput():
+    # stands for an input the worker already holds, so that it is not
+    # sent again
+    def __init__(self, node):
+        self.node = node
+
+
+class remoteworker():
+    # coordinator side state of a connected worker
+    def __init__(self, conn, host, pid):
+        self.conn = conn
+        self.host = host
+        self.pid = pid
+        self.held = set()
+        self.task = None
+
+    def name(self):
+        return self.host + ':' + str(self.pid)
+
+
+class clusterpool():
+    """Coordinator for pyleaf workers running on other hosts.
+
+    Listens on a TCP address (host, port) or on a Unix socket path
+    and accepts any number of pyleaf-worker processes, each running
+    one node at a time. A worker keeps the results it produced: a node
+    is preferably placed on an idle worker that already holds its
+    inputs, which are then not sent again.
+
+    """
+
+    def __init__(self, address=('localhost', 0), authkey=None,
+                 modnames=(), paths=()):
+        from multiprocessing.connection import Listener
+        if authkey == None:
+            authkey = getKey()
+        if authkey == None:
+            #peers are trusted once authenticated: the key must not
+            #be guessable
+            authkey = os.urandom(16).hex().encode()
+        self._authkey = authkey
+        self._listener = Listener(address, authkey=authkey)
+        self._modnames = tuple(modnames)
+        self._paths = tuple(paths)
+        self._workers = list()
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._lastid = 0
+        self._closed = False
+        #worker that produced the result of each finished task
+        self._producers = weakref.WeakKeyDictionary()
+        dbgstr('Waiting for workers on: ' + str(self.address()))
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def address(self):
+        return self._listener.address
+
+    def authkey(self):
+        return self._authkey
+
+    def size(self):
+        return len(self._workers)
+
+    def matches(self, maxworkers):
+        return True
+
+    def waitWorkers(self, n, timeout=None):
+        # blocks until at least n workers are connected
+        with self._changed:
+            return self._changed.wait_for(lambda: len(self._workers) >= n,
+                                          timeout)
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+                msg = conn.recv()
+            except Exception:
+                if self._closed:
+                    return
+                dbgstr('A worker failed to connect.')
+                continue
+            worker = remoteworker(conn, msg[1], msg[2])
+            conn.send(('setup', self._modnames, self._paths))
+            dbgstr('Worker connected: ' + worker.name())
+            with self._changed:
+                self._workers.append(worker)
+                self._dispatch()
+                self._changed.notify_all()
+            threading.Thread(target=self._receive, args=(worker,),
+                             daemon=True).start()
+
+    def _receive(self, worker):
+        while True:
+            try:
+                msg = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                task, node, store = worker.task[1:]
+                worker.task = None
+                if msg[0] == 'done' and store:
+                    #the worker replaced its copy: it holds the new
+                    #one only once the caller keeps it
+                    worker.held.discard(node)
+                    self._producers[task] = worker
+                self._dispatch()
+            if msg[0] == 'done':
+                task.set_result(msg[2])
+            else:
+                task.set_exception(NameError(
+                    'Node ' + node + ' failed on worker ' + worker.name() +
+                    ':\n' + msg[2]))
+
+        dbgstr('Worker disconnected: ' + worker.name())
+        with self._lock:
+            self._workers.remove(worker)
+            lost = worker.task
+            worker.task = None
+        if lost != None and not self._closed:
+            lost[1].set_exception(NameError(
+                'Worker ' + worker.name() + ' was lost while running ' +
+                lost[2] + '.'))
+
+    def _place(self, innodes):
+        # the idle worker holding most of the given inputs
+        best = None
+        for worker in self._workers:
+            if worker.task != None:
+                continue
+            held = len([x for x in innodes if x in worker.held])
+            if best == None or held > best[0]:
+                best = (held, worker)
+        return None if best == None else best[1]
+
+    def _dispatch(self):
+        # sends pending tasks to idle workers; lock must be held
+        while len(self._pending) > 0:
+            kind, task, node, funct, args, innodes = self._pending[0]
+            worker = self._place(innodes)
+            if worker == None:
+                return
+            self._pending.popleft()
+            if kind == 'run':
+                args = [heldinput(innode) if innode in worker.held
+                        else param for innode, param in zip(innodes, args)]
+                held = [x for x in innodes if x in worker.held]
+                if len(held) > 0:
+                    dbgstr('Running ' + node + ' on ' + worker.name() +
+                           ', which holds: ' + ', '.join(held), 2)
+            self._lastid += 1
+            worker.task = (self._lastid, task, node, kind == 'run')
+            try:
+                worker.conn.send((kind, self._lastid, node, funct, args))
+            except Exception as e:
+                worker.task = None
+                task.set_exception(e)
+
+    def keep(self, task, node):
+        # the result of task, stored by the caller as node, is still
+        # held by the worker that produced it
+        with self._lock:
+            worker = self._producers.pop(task, None)
+            if worker != None and worker in self._workers:
+                worker.held.add(node)
+
+    def forget(self, node):
+        # node has changed or is no longer needed: copies held by the
+        # workers must not be used
+        with self._lock:
+            for worker in self._workers:
+                if node in worker.held:
+                    worker.held.discard(node)
+                    try:
+                        worker.conn.send(('forget', node))
+                    except Exception:
+                        pass
+
+    def _submit(self, kind, node, funct, args, innodes):
+        from concurrent.futures import Future
+        task = Future()
+        with self._lock:
+            self._pending.append((kind, task, node, funct, args,
+                                  list(innodes)))
+            self._dispatch()
+        return task
+
+    def submit(self, node, funct, nodeparams, innodes=()):
+        # innodes name the nodes producing nodeparams, in the same order
+        innodes = list(innodes) + [None] * (len(nodeparams) - len(innodes))
+        return self._submit('run', node, funct, nodeparams, innodes)
+
+    def map(self, node, funct, items, chunksize=1):
+        from pyleaf.sch import splitChunks
+        return gatherChunks(node, [self._submit('map', node, funct, chunk, [])
+                                   for chunk in splitChunks(items,
+                                                            chunksize)])
+
+    def shutdown(self):
+        dbgstr('Shutting down workers.', 2)
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.conn.send(('stop',))
+                worker.conn.close()
+            except Exception:
+                pass
+        self._listener.close()
+
+
+def getKey():
+    # the key given through the environment, if any
+    authkey = os.environ.get(keyvar)
+    return None if authkey == None else authkey.encode()
+
+
+def runWorker(address, authkey=None, paths=()):
+    """Connects to a coordinator and runs the nodes it sends until it
+    says to stop or goes away."""
+    from multiprocessing.connection import Client
+    if authkey == None:
+        authkey = getKey()
+    if authkey == None:
+        raise NameError('No authentication key given: use the key ' +
+                        'printed by the coordinator.')
+    conn = Client(address, authkey=authkey)
+    conn.send(('hello', socket.gethostname(), os.getpid()))
+    msg = conn.recv()
+    for path in list(paths) + list(msg[2]):
+        if os.path.isdir(path) and not path in sys.path:
+            sys.path.insert(0, path)
+    for modname in msg[1]:
+        __import__(modname)
+
+    held = dict()
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg[0] == 'stop':
+            break
+        if msg[0] == 'forget':
+            held.pop(msg[1], None)
+            continue
+        kind, taskid, node, funct, args = msg
+        try:
+            if kind == 'run':
+                args = [makeParam(held[x.node]) if isinstance(x, heldinput)
+                        else x for x in args]
+                newres = runTask(node, funct, args)
+                held[node] = newres[0]
+            else:
+                newres = runChunk(node, funct, args)
+            conn.send(('done', taskid, newres))
+        except Exception:
+            conn.send(('failed', taskid, traceback.format_exc()))
+    conn.close()
+
+
+def parseAddress(address):
+    # "host:port" is a TCP address, anything else a Unix socket path
+    host, sep, port = address.rpartition(':')
+    if sep != '' and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+
+def main(argv=None):
+    """Entry point of pyleaf-worker."""
+    import argparse
+    import multiprocessing
+    parser = argparse.ArgumentParser(
+        prog='pyleaf-worker',
+        description='Runs the nodes of a pyleaf protocol on behalf of ' +
+        'a coordinator (see protocol.setCluster).')
+    parser.add_argument('address', help='coordinator address, as ' +
+                        'host:port or as the path of a Unix socket')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                        help='number of worker processes to start')
+    parser.add_argument('-k', '--authkey', default=None,
+                        help='authentication key shared with the ' +
+                        'coordinator (default: $' + keyvar + ')')
+    parser.add_argument('-p', '--path', action='append', default=[],
+                        help='directory where user modules are found')
+    args = parser.parse_args(argv)
+
+    address = parseAddress(args.address)
+    authkey = getKey()
+    if args.authkey != None:
+        authkey = args.authkey.encode()
+    if authkey == None:
+        parser.error('an authentication key is needed: use the key ' +
+                     'printed by the coordinator')
+    if args.workers == 1:
+        runWorker(address, authkey, args.path)
+        return
+    procs = [multiprocessing.Process(target=runWorker,
+                                     args=(address, authkey, args.path))
+             for i in range(args.workers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+if __name__ == '__main__':
+    #run from the imported module, whose classes the coordinator sends
+    from pyleaf import wrk
+    wrk.main()
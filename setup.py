@@ -3,6 +3,7 @@ from distutils.core import setup
 setup(
     name = "pyleaf",
     packages = ["pyleaf"],
+    scripts = ["scripts/pyleaf-worker"],
     package_data={'pyleaf': ['resources/leaf.png','resources/style.css']},
     #data_files=[('pyleaf', ['resources/leaf.png','resources/style.css'])],
     version = "1.0.1",
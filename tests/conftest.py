@@ -0,0 +1,38 @@
+import os
+import sys
+import itertools
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyleaf import log
+from pyleaf.prj import project
+
+_modcount = itertools.count()
+
+
+@pytest.fixture
+def makeproject(tmp_path, monkeypatch):
+    """Returns a function building a project on the given source of a
+    user module, written in a temporary directory. The module must
+    define the LGL protocol in the variable named protocol."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setitem(log.stdopt, 'verbosity', 0)
+    projects = list()
+
+    def make(source):
+        modname = 'leafmod' + str(next(_modcount))
+        (tmp_path / (modname + '.py')).write_text(textwrap.dedent(source))
+        projects.append(project(modname, 'protocol'))
+        return projects[-1]
+
+    yield make
+
+    for pj in projects:
+        for name in pj.protocols:
+            if pj.protocols._isBuilt(name):
+                pj.protocols[name].closePool()
+        pj.closePool()
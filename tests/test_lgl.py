@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+from pyleaf import lgl
+from pyleaf.gph import graph, dotId
+
+
+def compiled(source):
+    g = graph()
+    g.load('lgl', source, 0)
+    return g
+
+
+def edges(g):
+    # every edge with its id
+    return sorted([(node, onode, g.getEdgeAttrib((node, onode), 'id'))
+                   for node in g for onode in g.getOutNodes(node)])
+
+
+def ids(g):
+    return dict([(node, g.getAttrib(node, 'id')) for node in g])
+
+
+def test_chain():
+    g = compiled('a -> b -> c;')
+    assert ids(g) == {'a': 0, 'b': 1, 'c': 2}
+    assert edges(g) == [('a', 'b', 0), ('b', 'c', 1)]
+    assert g.getTopoOrder() == ['a', 'b', 'c']
+
+
+def test_node_sets():
+    g = compiled('a, b -> c, d -> e[F, chunk=4];')
+    assert edges(g) == [('a', 'c', 0), ('a', 'd', 1), ('b', 'c', 2),
+                        ('b', 'd', 3), ('c', 'e', 4), ('d', 'e', 5)]
+    assert g.getAttrib('e', 'LEAF_FLAGS') == 'F'
+    assert g.getAttrib('e', 'chunk') == '4'
+
+
+def test_fork_and_reference():
+    g = compiled('''
+          / testFor -> report
+    genData <
+          \\ testSum -> @report -> exportRes[F];''')
+    assert ids(g) == {'testFor': 0, 'report': 1, 'genData': 2,
+                      'testSum': 3, 'exportRes': 4}
+    assert edges(g) == [('genData', 'testFor', 1), ('genData', 'testSum', 4),
+                        ('report', 'exportRes', 3), ('testFor', 'report', 0),
+                        ('testSum', 'report', 2)]
+    assert g.getAttrib('report', 'hash') == 'true'
+    assert g.getAttrib('testFor', 'hash') == None
+
+
+def test_nested_forks():
+    g = compiled('''
+          /E
+        B<
+       /  \\  /F
+           D<
+             \\G
+
+    A <
+       \\C
+    ;''')
+    assert sorted(g.getOutNodes('A')) == ['B', 'C']
+    assert sorted(g.getOutNodes('B')) == ['D', 'E']
+    assert sorted(g.getOutNodes('D')) == ['F', 'G']
+    assert g.getAncestors('G') == set(['A', 'B', 'D'])
+
+
+def test_named_objects():
+    g = compiled('G: 1, 2, 3;\n G -> @G;')
+    assert edges(g) == [('1', '2', 0), ('1', '3', 1), ('2', '1', 2),
+                        ('2', '3', 3), ('3', '1', 4), ('3', '2', 5)]
+    g = compiled('G: 1, 2, 3;\n G -> G;')
+    assert sorted(g.getOutNodes('2')) == ['1.1', '2.1', '3.1']
+
+
+def test_family_attribute():
+    g = compiled('a -> b[i in 0..n, k=v] -> c;')
+    assert g.getAttrib('b', 'shards') == (0, 'n')
+    assert g.getAttrib('b', 'k') == 'v'
+
+
+@pytest.mark.parametrize('source, line', [('a -> @zz;\nb', 1),
+                                          ('a ->\n\n -> b', 3)])
+def test_syntax_errors(source, line):
+    with pytest.raises(NameError) as error:
+        lgl.compile(source, graph())
+    assert 'around line ' + str(line) in str(error.value)
+
+
+def test_add_family():
+    g = compiled('a, b -> f -> c;')
+    g.addFamily('f', range(3))
+    assert sorted(g.getOutNodes('a')) == ['f[0]', 'f[1]', 'f[2]']
+    assert g.getInNodes('f') == ['f[0]', 'f[1]', 'f[2]']
+    assert g.getInNodes('f[1]') == ['a', 'b']
+    assert g.getAttrib('f[2]', 'bind') == 'f'
+    assert g.getAttrib('f', 'gather') == 'true'
+    eids = [g.getEdgeAttrib(edge, 'id') for edge in
+            [(node, onode) for node in g for onode in g.getOutNodes(node)]]
+    assert len(set(eids)) == len(eids)
+
+
+def test_dot_ids():
+    assert dotId('f[0]') == '"f[0]"'
+    assert dotId('a"b\\') == '"a\\"b\\\\"'
+
+
+def test_wide_graphs():
+    # edges are added one at a time: building wide graphs and large
+    # families must not take quadratic time
+    t = time.time()
+    g = compiled('root -> ' + ', '.join(['w' + str(i) for i in range(3000)]) +
+                 ' -> sink;')
+    assert len(g.getOutNodes('root')) == 3000
+    assert len(g.getInNodes('sink')) == 3000
+    g = compiled('a -> f -> b;')
+    g.addFamily('f', range(3000))
+    assert len(g.getOutNodes('a')) == 3000
+    assert len(g.getInNodes('f')) == 3000
+    assert time.time() - t < 3
@@ -0,0 +1,108 @@
+import os
+import pytest
+
+ITERATOR = '''
+protocol = """
+gen[executor=process] -> total[executor=process];
+"""
+def gen():
+    return (i for i in range(100))
+def total(a):
+    return sum(a)
+'''
+
+
+@pytest.mark.parametrize('dump', [True, False])
+def test_process_node_returning_iterator(makeproject, dump):
+    p = makeproject(ITERATOR).protocols['']
+    if not dump:
+        p.dumpOff()
+    assert p.provide('total', parallel=True, max_workers=2) == 4950
+    assert list(p._getResource('gen').getValue()) == list(range(100))
+
+
+UNPICKLABLE = '''
+protocol = """
+data -> locked[executor=thread] -> use;
+data -> squares[executor=thread];
+"""
+import threading
+def data():
+    return list(range(10))
+def locked(x):
+    return threading.Lock()
+def use(x):
+    return x
+def squares(x):
+    return [i * i for i in x]
+'''
+
+
+def test_unstorable_result_fails_its_node(makeproject):
+    p = makeproject(UNPICKLABLE).protocols['']
+    with pytest.raises(NameError) as error:
+        p.provide(['use', 'squares'], parallel=True, max_workers=2)
+    assert 'Build failed at: locked' in str(error.value)
+    assert 'Not built: use' in str(error.value)
+    assert p._getResource('squares').isDumped()
+    assert not p._getResource('locked').isAvailable()
+    assert not [x for x in os.listdir(p._metafolder) if '.tmp' in x]
+
+
+FAMILY = '''
+nshards = 4
+protocol = """
+data -> part[shard in 0..nshards] -> total;
+"""
+def data():
+    return list(range(20))
+def part(x, shard):
+    return sum(x[shard::nshards])
+def total(parts):
+    return parts
+'''
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_family(makeproject, parallel):
+    p = makeproject(FAMILY).protocols['']
+    parts = [sum(range(20)[i::4]) for i in range(4)]
+    assert p.provide('total', parallel=parallel) == parts
+    assert p.provide('part[2]') == parts[2]
+
+
+DIAMOND = '''
+protocol = """
+      / sq[executor=process] -> report
+data <
+      \\\\ neg[executor=thread] -> @report;
+"""
+def data():
+    return list(range(10))
+def sq(x):
+    return [i * i for i in x]
+def neg(x):
+    return [-i for i in x]
+def report(a, b):
+    return sum(a) + sum(b)
+'''
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_parallel_provide(makeproject, max_workers):
+    serial = makeproject(DIAMOND).protocols['']
+    p = makeproject(DIAMOND).protocols['']
+    assert p.provide('report', parallel=True,
+                     max_workers=max_workers) == serial.provide('report')
+    assert p.provide(['sq', 'neg'], parallel=True) == [serial.provide('sq'),
+                                                       serial.provide('neg')]
+    built = p._getResource('sq').getValue()
+    p.provide('report', parallel=True)
+    assert p._getResource('sq').getValue() is built
+
+
+def test_provide_async(makeproject):
+    p = makeproject(DIAMOND).protocols['']
+    futures = p.provide_async(['report', 'sq'], parallel=True)
+    assert p.provide('neg') == [-i for i in range(10)]
+    assert [x.result(60) for x in futures] == [240, [i * i for i in range(10)]]
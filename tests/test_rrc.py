@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from pyleaf import log
+from pyleaf.rrc import resource, getCodec, checkCompression
+
+VALUES = [[1, 'two', {3: 4.0}], b'raw bytes' * 1000,
+          bytearray(b'\x00\x01' * 1000), 'text', None]
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setitem(log.stdopt, 'verbosity', 0)
+
+
+def roundtrip(path, value, codec='auto', compression=None):
+    res = resource('node', str(path))
+    res.setCodec(codec)
+    res.setCompression(compression)
+    res.setValue(value)
+    res.updateFingerprint()
+    res.dump()
+    return resource('node', str(path))
+
+
+@pytest.mark.parametrize('value', VALUES)
+@pytest.mark.parametrize('codec', ['auto', 'pickle', 'pickle5'])
+@pytest.mark.parametrize('compression', [None, 'auto', 'zlib', 'bz2', 'lzma'])
+def test_roundtrip(tmp_path, value, codec, compression):
+    loaded = roundtrip(tmp_path / 'node.res', value, codec, compression)
+    assert loaded.getValue() == value
+    assert type(loaded.getValue()) == type(value)
+
+
+def test_values_are_loaded_lazily(tmp_path):
+    loaded = roundtrip(tmp_path / 'node.res', [1, 2, 3])
+    assert loaded._pending
+    assert loaded._contents == None
+    assert loaded.getValue() == [1, 2, 3]
+    assert not loaded._pending
+
+
+def test_fingerprint_read_from_value(tmp_path):
+    # a fingerprint equal to the value is not written twice
+    loaded = roundtrip(tmp_path / 'node.res', list(range(100)))
+    assert loaded._fingerprint is resource
+    assert loaded.getFingerprint() == list(range(100))
+    loaded.getValue()
+    assert not loaded.changed()
+
+
+def test_failed_dump_leaves_no_files(tmp_path):
+    import threading
+    with pytest.raises(TypeError):
+        roundtrip(tmp_path / 'node.res', threading.Lock())
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_auto_codec():
+    assert getCodec('auto', b'x').name == 'raw'
+    assert getCodec('auto', [1]).name == 'pickle5'
+
+
+def test_numpy_codecs(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    array = numpy.arange(1000.0).reshape(10, 100)
+    assert getCodec('auto', array).name == 'npy'
+    assert getCodec('auto', dict(a=array)).name == 'npz'
+    for compression in [None, 'zlib']:
+        loaded = roundtrip(tmp_path / 'a.res', array, 'auto', compression)
+        assert (loaded.getValue() == array).all()
+        loaded = roundtrip(tmp_path / 'd.res', dict(a=array, b=array[0]),
+                           'auto', compression)
+        assert sorted(loaded.getValue().keys()) == ['a', 'b']
+        assert (loaded.getValue()['b'] == array[0]).all()
+
+
+def test_unknown_names():
+    with pytest.raises(NameError):
+        getCodec('nope')
+    with pytest.raises(NameError):
+        checkCompression('nope')
@@ -0,0 +1,97 @@
+from pyleaf.gph import graph
+from pyleaf.sch import scheduler, refcounter, parseSize
+
+
+def diamond():
+    #      / b -> d
+    #    a        \
+    #      \ c ---- e
+    g = graph()
+    for a, b in [('a', 'b'), ('a', 'c'), ('b', 'd'), ('d', 'e'), ('c', 'e')]:
+        g.addEdge(a, b)
+    return g
+
+
+def drain(sched):
+    # runs the schedule one node at a time
+    order = list()
+    while sched.hasReady():
+        node = sched.nextReady()
+        order.append(node)
+        sched.setDone(node)
+    return order
+
+
+def test_topological_order():
+    g = diamond()
+    order = drain(scheduler(g, ['a', 'b', 'c', 'd', 'e']))
+    assert order[0] == 'a' and order[-1] == 'e'
+    assert order.index('b') < order.index('d')
+
+
+def test_ready_only_when_inputs_are_done():
+    sched = scheduler(diamond(), ['a', 'b', 'c', 'd', 'e'])
+    assert sched.nextReady() == 'a'
+    assert not sched.hasReady()
+    sched.setDone('a')
+    assert sched.countReady() == 2
+    assert sched.countRunning() == 0
+    assert not sched.finished()
+
+
+def test_partial_builds():
+    # nodes out of the build are considered done
+    sched = scheduler(diamond(), ['d', 'e'])
+    assert drain(sched) == ['d', 'e']
+    assert sched.isDone('a')
+
+
+def test_critical_path_first():
+    # c is on the longest path to the end of the build
+    costs = dict(a=1, b=1, c=10, d=1, e=1)
+    sched = scheduler(diamond(), ['a', 'b', 'c', 'd', 'e'], costs)
+    assert sched.getPriority('a') == 12
+    assert drain(sched) == ['a', 'c', 'b', 'd', 'e']
+
+
+def test_ties_keep_submission_order():
+    g = graph()
+    for node in ['x', 'y', 'z']:
+        g.addNode(node)
+    sched = scheduler(g, ['x', 'y', 'z'], dict(x=1, y=1, z=1))
+    assert drain(sched) == ['x', 'y', 'z']
+
+
+def test_canrun_filter():
+    sched = scheduler(diamond(), ['a', 'b', 'c', 'd', 'e'])
+    sched.setDone(sched.nextReady())
+    node = sched.nextReady(lambda x: x == 'c')
+    assert node == 'c'
+    assert sched.nextReady(lambda x: x == 'c') == None
+    assert sched.nextReady() == 'b'
+
+
+def test_failures_stop_descendants():
+    sched = scheduler(diamond(), ['a', 'b', 'c', 'd', 'e'])
+    sched.setDone(sched.nextReady())
+    sched.nextReady(lambda x: x == 'b')
+    sched.setFailed('b')
+    assert drain(sched) == ['c']
+    assert sched.finished()
+    assert sorted(sched.unfinished()) == ['b', 'd', 'e']
+
+
+def test_refcounter():
+    refs = refcounter(diamond(), ['b', 'c', 'd', 'e'])
+    assert refs.release('b') == []
+    assert refs.release('c') == ['a']
+    assert refs.isUnused('a')
+    assert not refs.isUnused('d')
+    assert sorted(refs.release('e')) == ['c', 'd']
+
+
+def test_parse_size():
+    assert parseSize(None) == None
+    assert parseSize(100) == 100
+    assert parseSize('2K') == 2048
+    assert parseSize('1.5G') == int(1.5 * 1024 ** 3)